@@ -0,0 +1,218 @@
+import os
+import tempfile
+import time
+import numpy as np
+from PIL import Image, ImageDraw
+from processor import (rasterize_waveform, rasterize_spectrum, draw_waveform, draw_spectrum, FFmpegWriter,
+                       get_render_profile, create_compositor, raw_frame_shape, unpack_frame_bits)
+from settings import *
+
+
+def draw_waveform_reference(waveform_data, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_WAVEFORM):
+    """
+    Прежняя отрисовка волны: по одному вызову draw.line на столбец
+    """
+    img = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    center_y = height // 2
+
+    for i, sample in enumerate(waveform_data):
+        y_offset = int(sample * center_y * 0.8)
+        draw.line([(i, center_y - y_offset), (i, center_y + y_offset)], fill=(0, 0, 0), width=1)
+
+    center_x = width // 2
+    draw.line([(center_x, 0), (center_x, height)], fill=(255, 0, 0), width=2)
+    return img
+
+
+def draw_spectrum_reference(fft_display, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_SPECTRUM):
+    """
+    Прежняя отрисовка спектра: до двух вызовов draw.line на столбец
+    """
+    img = Image.new('RGB', (width, height), (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+
+    for i, magnitude in enumerate(fft_display):
+        enhanced_magnitude = np.power(magnitude, 0.7)
+        bar_height = max(int(enhanced_magnitude * height * 0.98), 1)
+        bar_height = min(bar_height, height - 1)
+        line_width = max(1, int(enhanced_magnitude * 2))
+
+        for w in range(line_width):
+            if i + w < width:
+                draw.line([(i + w, height - 1), (i + w, height - bar_height)], fill=(0, 0, 0), width=1)
+
+    return img
+
+
+def _measure(func, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def benchmark_rasterizer(repeats=200, seed=0):
+    """
+    Сравнивает векторную отрисовку панелей с попиксельной через ImageDraw:
+    проверяет совпадение пикселей и печатает время на кадр для маски панели
+    и для готового RGB изображения
+    """
+    rng = np.random.default_rng(seed)
+    waveform = (rng.standard_normal(VISUALIZATION_WIDTH) * 0.5).astype(np.float32)
+    spectrum = rng.random(VISUALIZATION_WIDTH).astype(np.float32)
+    spectrum[:10] = 1.0
+
+    results = {}
+    for name, reference, draw, rasterize, data, height in [
+        ("waveform", draw_waveform_reference, draw_waveform, rasterize_waveform, waveform,
+         VISUALIZATION_HEIGHT_WAVEFORM),
+        ("spectrum", draw_spectrum_reference, draw_spectrum, rasterize_spectrum, spectrum,
+         VISUALIZATION_HEIGHT_SPECTRUM),
+    ]:
+        expected = np.array(reference(data, VISUALIZATION_WIDTH, height))
+        actual = np.array(draw(data, VISUALIZATION_WIDTH, height))
+        if not np.array_equal(expected, actual):
+            raise AssertionError(f"Панель {name}: пиксели не совпадают с ImageDraw")
+
+        reference_ms = _measure(lambda: reference(data, VISUALIZATION_WIDTH, height), repeats)
+        draw_ms = _measure(lambda: draw(data, VISUALIZATION_WIDTH, height), repeats)
+        rasterize_ms = _measure(lambda: rasterize(data, VISUALIZATION_WIDTH, height), repeats)
+        results[name] = (reference_ms, draw_ms, rasterize_ms)
+        print(f"{name}: ImageDraw {reference_ms:.3f} мс, NumPy RGB {draw_ms:.3f} мс, "
+              f"NumPy маска {rasterize_ms:.3f} мс (ускорение x{reference_ms / rasterize_ms:.1f})")
+
+    return results
+
+
+def synthetic_frames(width, height, count, seed=0):
+    """
+    Черно-белые кадры, похожие на кадры визуализатора: крупные статичные блоки
+    и столбцы, которые меняются от кадра к кадру
+    """
+    rng = np.random.default_rng(seed)
+    base = np.where(rng.random((height // 8, width // 8)) < 0.5, 0, 255).astype(np.uint8)
+    base = np.repeat(np.repeat(base, 8, axis=0), 8, axis=1)
+    rows = np.arange(height)[:, None]
+    for _ in range(count):
+        frame = base.copy()
+        panel = frame[height // 2:, :width // 4]
+        bars = rng.integers(0, panel.shape[0], panel.shape[1])
+        panel[rows[:panel.shape[0]] >= bars[None, :]] = 0
+        yield frame
+
+def benchmark_encoder_input(frames=90, profile_name=RENDER_PROFILE):
+    """
+    Сравнивает передачу кадров в кодировщик в формате rgb24, gray и monob:
+    объем данных через pipe, скорость кодирования и размер готового файла.
+    Выход во всех случаях - VIDEO_PIX_FMT, поэтому файлы совместимы с YouTube и Telegram
+    """
+    profile = get_render_profile(profile_name)
+    size = (profile.width, profile.height)
+    gray_frames = list(synthetic_frames(profile.width, profile.height, frames))
+    inputs = {
+        'rgb24': [np.repeat(frame[:, :, None], 3, axis=2) for frame in gray_frames],
+        'gray': gray_frames,
+        'monob': [np.packbits(frame >= 128, axis=1) for frame in gray_frames],
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for pix_fmt, data in inputs.items():
+            output_path = os.path.join(temp_dir, f"{pix_fmt}.mp4")
+            start = time.perf_counter()
+            with FFmpegWriter(output_path, size, profile.fps, input_pix_fmt=pix_fmt) as writer:
+                for frame in data:
+                    writer.write_frame(frame)
+            elapsed = time.perf_counter() - start
+
+            piped_mb = sum(frame.nbytes for frame in data) / 1024 / 1024
+            output_kb = os.path.getsize(output_path) / 1024
+            results[pix_fmt] = (frames / elapsed, piped_mb, output_kb)
+            print(f"{pix_fmt}: {frames / elapsed:.1f} кадр/с, через pipe {piped_mb:.1f} МБ, "
+                  f"файл {output_kb:.0f} КБ")
+
+    rgb_fps = results['rgb24'][0]
+    for pix_fmt in ('gray', 'monob'):
+        print(f"{pix_fmt} относительно rgb24: ускорение x{results[pix_fmt][0] / rgb_fps:.2f}")
+    return results
+
+
+def synthetic_layers(width, height, count, fade_frames=30, seed=0):
+    """
+    Наборы слоев для компоновщика, похожие на кадры визуализатора: дрожащая обложка чуть выше
+    кадра с несколькими вариантами содержимого, две панели (новые каждый кадр), GIF и статичный
+    текст. Первые fade_frames кадров панели, GIF и текст выплывают
+    """
+    rng = np.random.default_rng(seed)
+
+    def plane(h, w):
+        return np.where(rng.random((h // 4 + 1, w // 4 + 1)) < 0.5, 0, 255).astype(np.uint8).repeat(
+            4, axis=0).repeat(4, axis=1)[:h, :w]
+
+    main_size = height * 26 // 25
+    covers = [plane(main_size, main_size) for _ in range(4)]
+    gif_frames = [plane(height // 6, height // 6) for _ in range(8)]
+    artist, title = plane(height // 16, width // 4), plane(height // 16, width // 3)
+    panel_width = width * 2 // 5
+    main_x, main_y = width - main_size, (height - main_size) // 2
+    for index in range(count):
+        fade_alpha = min(255, 255 * index // fade_frames) if fade_frames else 255
+        cover = int(rng.integers(len(covers)))
+        dx, dy = (int(v) for v in rng.integers(-6, 7, 2))
+        yield [
+            ('main', ('main', cover), covers[cover], main_x + dx, main_y + dy, 255),
+            ('spectrum', None, plane(height // 4, panel_width), width // 20, height // 10, fade_alpha),
+            ('waveform', None, plane(height // 8, panel_width), width // 20, height // 2, fade_alpha),
+            ('gif', ('gif', index % len(gif_frames)), gif_frames[index % len(gif_frames)],
+             width // 20, height * 3 // 4, fade_alpha),
+            ('artist', 'artist', artist, width // 20, height // 30, fade_alpha),
+            ('title', 'title', title, width // 20, height // 30 + height // 14, fade_alpha),
+        ]
+
+def benchmark_compositors(frames=240, profile_name=RENDER_PROFILE, buffers=3, repeats=3):
+    """
+    Время сборки кадра компоновщиками (8-битный с выходом gray и rgb24, 1-битный monob)
+    на одной последовательности слоев (лучшее из repeats проходов). Кадры собираются в буферы,
+    которые переиспользуются по кругу, как буферы кодировщика. Отдельно печатается время кадров
+    с выплыванием (дизеринг) и без него; последний кадр 1-битного компоновщика сверяется с 8-битным.
+    1-битный выигрывает за счет кэша упакованных слоев (дрожащая обложка не упаковывается заново)
+    и того, что вставка и перенос в буфер кодировщика идут по байтам, а не по пикселям
+    """
+    profile = get_render_profile(profile_name)
+    fade_frames = frames // 8
+    layers = list(synthetic_layers(profile.width, profile.height, frames, fade_frames))
+
+    results = {}
+    outputs = {}
+    for mode, pix_fmt in (('gray', 'gray'), ('gray', 'rgb24'), ('bitplane', 'monob')):
+        fade_ms = steady_ms = float('inf')
+        for _ in range(repeats):
+            compositor, frame_pix_fmt = create_compositor(profile.width, profile.height, mode, pix_fmt)
+            pool = [np.empty(raw_frame_shape(frame_pix_fmt, profile.width, profile.height), dtype=np.uint8)
+                    for _ in range(buffers)]
+            timings = []
+            for index, frame_layers in enumerate(layers):
+                start = time.perf_counter()
+                frame = compositor.compose(frame_layers, pool[index % buffers])
+                timings.append(time.perf_counter() - start)
+            outputs[pix_fmt] = frame.copy()
+            fade_ms = min(fade_ms, np.mean(timings[:fade_frames]) * 1000)
+            steady_ms = min(steady_ms, np.mean(timings[fade_frames:]) * 1000)
+
+        results[pix_fmt] = (fade_ms, steady_ms)
+        print(f"{mode} -> {pix_fmt}: выплывание {fade_ms:.2f} мс/кадр, без выплывания {steady_ms:.2f} мс/кадр, "
+              f"буфер кадра {pool[0].nbytes / 1024:.0f} КБ")
+
+    if not np.array_equal(unpack_frame_bits(outputs['monob'], profile.width), outputs['gray']):
+        raise AssertionError("1-битный кадр не совпадает с 8-битным")
+    return results
+
+
+if __name__ == "__main__":
+    print("=== БЕНЧМАРК ОТРИСОВКИ ПАНЕЛЕЙ ===")
+    benchmark_rasterizer()
+    print("\n=== БЕНЧМАРК ВХОДА КОДИРОВЩИКА ===")
+    benchmark_encoder_input()
+    print("\n=== БЕНЧМАРК КОМПОНОВЩИКОВ ===")
+    benchmark_compositors()
@@ -1,6 +1,9 @@
 import os
 import asyncio
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from datetime import datetime, timedelta
 import pytz
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -14,7 +17,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from processor import create_audio_visualizer, get_audio_metadata, extract_album_art, add_white_square_background, \
-    apply_ultra_hard_threshold_effect
+    apply_ultra_hard_threshold_effect, prepare_track_features
 from youtube_uploader import upload_to_youtube_scheduled, create_auth_url, complete_auth
 from bot_settings import *
 from settings import *
@@ -33,6 +36,10 @@ class SyntunesBot:
         self.token = token
         self.youtube_credentials = youtube_credentials
         self.user_sessions = {}
+        # Фоновый анализ треков и спекулятивные рендеры идут в отдельных потоках с пониженным приоритетом:
+        # долгий рендер не задерживает анализ следующего трека
+        self.background_executor = ThreadPoolExecutor(max_workers=1, initializer=self.lower_thread_priority)
+        self.speculative_executor = ThreadPoolExecutor(max_workers=1, initializer=self.lower_thread_priority)
         self.db = Database()
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -91,6 +98,13 @@ class SyntunesBot:
                 'processing_message_id': None
             }
 
+            # Декодирование и анализ трека заранее, пока пользователь настраивает параметры
+            asyncio.get_event_loop().run_in_executor(
+                self.background_executor,
+                prepare_track_features,
+                audio_path
+            ).add_done_callback(lambda job: job.cancelled() or job.exception())
+
             await self.show_audio_menu(update, context, user_id)
 
         except Exception as e:
@@ -124,13 +138,67 @@ class SyntunesBot:
         cover.save(output_path, 'JPEG', quality=95, optimize=True)
         return output_path
 
-    def create_preview_video(self, input_path, output_path):
-        from moviepy.editor import VideoFileClip
-        video = VideoFileClip(input_path)
-        preview = video.subclip(0, min(15, video.duration))
-        preview.write_videofile(output_path, codec='libx264', audio_codec='aac', verbose=False, logger=None)
-        video.close()
-        preview.close()
+    @staticmethod
+    def lower_thread_priority():
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        except (AttributeError, OSError):
+            pass
+
+    def start_full_render(self, session, background=False):
+        """
+        Запускает полный рендер видео, если он еще не запущен, и возвращает его задачу.
+        background=True - спекулятивный рендер с пониженным приоритетом
+        """
+        if session.get('render_job') is None:
+            cancel_event = threading.Event()
+            executor = self.speculative_executor if background else None
+            session['render_cancel'] = cancel_event
+            session['render_background'] = background
+            session['render_job'] = asyncio.get_event_loop().run_in_executor(
+                executor,
+                partial(create_audio_visualizer, artist=session['current_artist'], title=session['current_title']),
+                session['audio_path'],
+                session['cover_path'],
+                session['video_path'],
+                session['current_bpm'],
+                BEATS_PER_LOOP,
+                RENDER_WORKERS,
+                None,
+                False,
+                cancel_event
+            )
+        return session['render_job']
+
+    async def finish_full_render(self, session):
+        """
+        Дожидается полного рендера подтвержденного видео. Незаконченный спекулятивный рендер
+        не перезапускается (закодированные кадры пропали бы), а дожидается до конца: вернуть
+        обычный приоритет потоку и ffmpeg без прав нельзя. Заново запускается только рендер,
+        завершившийся ошибкой
+        """
+        render_job = session.get('render_job')
+        if render_job is not None and session.get('render_background'):
+            try:
+                await render_job
+                return
+            except Exception as e:
+                logger.warning(f"Спекулятивный рендер не удался, запускаю заново: {e}")
+                self.cancel_full_render(session)
+        await self.start_full_render(session)
+
+    def cancel_full_render(self, session):
+        """
+        Останавливает полный рендер (например, если параметры видео изменились)
+        """
+        session.pop('render_background', None)
+        cancel_event = session.pop('render_cancel', None)
+        if cancel_event is not None:
+            cancel_event.set()
+        render_job = session.pop('render_job', None)
+        if render_job is not None:
+            # Исключение отмененного рендера никому не нужно
+            render_job.add_done_callback(lambda job: job.cancelled() or job.exception())
 
     async def show_audio_menu(self, update, context, user_id):
         session = self.user_sessions[user_id]
@@ -425,6 +493,7 @@ class SyntunesBot:
             return await self.create_video(query, context, user_id)
 
         elif data == "back_to_audio":
+            self.cancel_full_render(session)
             await self.update_audio_menu(query, context, user_id)
             return MAIN_MENU
 
@@ -785,24 +854,24 @@ class SyntunesBot:
         processing_msg = await query.edit_message_caption(caption=VIDEO_CREATING)
         session['processing_message_id'] = processing_msg.message_id
 
+        self.cancel_full_render(session)
+
         try:
             output_path = f"{session['user_dir']}/video.mp4"
             preview_path = f"{session['user_dir']}/preview.mp4"
 
+            # В режиме превью полное видео рендерится только после подтверждения
             await asyncio.get_event_loop().run_in_executor(
                 None,
-                create_audio_visualizer,
+                partial(create_audio_visualizer, artist=session['current_artist'], title=session['current_title']),
                 session['audio_path'],
                 session['cover_path'],
                 output_path,
-                session['current_bpm']
-            )
-
-            await asyncio.get_event_loop().run_in_executor(
-                None,
-                self.create_preview_video,
-                output_path,
-                preview_path
+                session['current_bpm'],
+                BEATS_PER_LOOP,
+                RENDER_WORKERS,
+                preview_path,
+                PREVIEW_FIRST
             )
 
             session['video_path'] = output_path
@@ -848,6 +917,9 @@ class SyntunesBot:
                     parse_mode=ParseMode.MARKDOWN
                 )
 
+            if PREVIEW_FIRST and PREVIEW_SPECULATIVE_RENDER:
+                self.start_full_render(session, background=True)
+
         except Exception as e:
             logger.error(f"Ошибка создания видео: {e}")
             await processing_msg.edit_caption(caption=ERROR_CREATING_VIDEO)
@@ -856,9 +928,16 @@ class SyntunesBot:
 
     async def upload_to_youtube(self, query, context, user_id):
         session = self.user_sessions[user_id]
-        await query.edit_message_caption(caption=UPLOADING_YOUTUBE)
 
         try:
+            if PREVIEW_FIRST:
+                # Дожидаемся полного рендера (он мог начаться заранее)
+                await query.edit_message_caption(caption=VIDEO_RENDERING_FULL)
+                await self.finish_full_render(session)
+                session.pop('render_cancel', None)
+
+            await query.edit_message_caption(caption=UPLOADING_YOUTUBE)
+
             video_path = session['video_path']
             title = self.generate_youtube_title(session)
             description = session['youtube_description']
@@ -893,6 +972,11 @@ class SyntunesBot:
 
         except Exception as e:
             logger.error(f"Ошибка загрузки на YouTube: {e}")
+            render_job = session.get('render_job')
+            if render_job is not None and render_job.done() and not render_job.cancelled() \
+                    and render_job.exception() is not None:
+                # Неудачный рендер перезапустится при следующей попытке
+                self.cancel_full_render(session)
             await query.edit_message_caption(caption=ERROR_UPLOADING_YOUTUBE)
 
         return MAIN_MENU
@@ -954,6 +1038,7 @@ class SyntunesBot:
     def cleanup_session(self, user_id):
         if user_id in self.user_sessions:
             session = self.user_sessions[user_id]
+            self.cancel_full_render(session)
             user_dir = session.get('user_dir')
             if user_dir and os.path.exists(user_dir):
                 import shutil
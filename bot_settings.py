@@ -104,6 +104,7 @@ TYPE_SELECTED = "✅ Тайп '{}' выбран!"
 
 # Создание видео
 VIDEO_CREATING = "🎬 Создаю видео... Это может занять несколько минут."
+VIDEO_RENDERING_FULL = "🎬 Создаю полное видео... Это может занять несколько минут."
 VIDEO_CREATED_SCHEDULED = """
 🎬 **Видео готово!**
 
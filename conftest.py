@@ -0,0 +1,27 @@
+import wave
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def make_wav(tmp_path):
+    """
+    Стерео WAV для тестов в tmp_path: два тона, шум и редкие щелчки (транзиенты для пиков волны)
+    """
+    def make(seconds, name="track.wav", sample_rate=44100, seed=0):
+        rng = np.random.default_rng(seed)
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        signal = 0.3 * np.sin(2 * np.pi * 110 * t) + 0.2 * np.sin(2 * np.pi * 1760 * t) * (t % 0.5 < 0.25)
+        signal += 0.05 * rng.standard_normal(len(t))
+        signal[rng.integers(0, len(t), 40)] = 0.95
+        stereo = np.stack([signal, 0.8 * signal], axis=1)
+        path = tmp_path / name
+        with wave.open(str(path), 'wb') as f:
+            f.setnchannels(2)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes((np.clip(stereo, -1, 1) * 32767).astype('<i2').tobytes())
+        return str(path)
+
+    return make
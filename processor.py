@@ -1,10 +1,29 @@
 import numpy as np
-from moviepy.editor import AudioFileClip, VideoClip
 from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont
 import os
+import re
 import librosa
+import hashlib
+import contextlib
+import math
+import multiprocessing
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import weakref
+from collections import OrderedDict, deque, namedtuple
+from functools import lru_cache
+from scipy import ndimage
+from scipy.signal import lfilter, resample_poly
 from settings import *
 
+# Веса каналов для яркости (0.2989, 0.5870, 0.1140 - те же, что и в эффекте порога) в десятитысячных
+LUMINANCE_WEIGHTS = np.array([2989, 5870, 1140], dtype=np.uint32)
+# Яркость красной центральной линии волны
+PLAYHEAD_LUMINANCE = 255 * int(LUMINANCE_WEIGHTS[0]) // 10000
+
 def get_audio_metadata(audio_path):
     """
     Извлекает метаданные из аудиофайла
@@ -43,18 +62,28 @@ def get_audio_metadata(audio_path):
 
     return "Unknown Artist", "Unknown Title"
 
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def cached_font(path, size):
+    """
+    Шрифт из файла, разобранный один раз на процесс для каждой пары (путь, размер)
+    """
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        print(f"Шрифт {path} не найден, использую стандартный")
+        return None
+
 def load_font(size=36):
     """
     Загружает фиксированный шрифт MisterBrush.ttf
     """
+    font = cached_font(FONT_FILE, size)
+    if font is not None:
+        return font
     try:
-        return ImageFont.truetype(FONT_FILE, size)
+        return ImageFont.load_default()
     except:
-        print(f"Шрифт {FONT_FILE} не найден, использую стандартный")
-        try:
-            return ImageFont.load_default()
-        except:
-            return None
+        return None
 
 def create_thumbnail(image_path, output_path):
     """
@@ -82,69 +111,83 @@ def create_thumbnail(image_path, output_path):
     thumbnail.save(output_path, 'JPEG', quality=95, optimize=True)
     print(f"Обложка YouTube сохранена: {output_path} (1280x720)")
 
-def create_text_blocks(artist, title):
+def create_text_blocks(artist, title, size=(TEXT_BLOCK_WIDTH, TEXT_LINE_HEIGHT)):
     """
     Создает два отдельных блока текста с улучшенной обработкой высоты
     """
     def create_single_text_block(text):
-        font_size = 200
-        best_font = None
-        best_text_w = 0
-        best_text_h = 0
+        # Блоки из кэша общие для всех рендеров: отдаем копию
+        return render_text_block(text, *size).copy()
 
-        while font_size > 20:
-            test_font = load_font(font_size)
-            if test_font is None:
-                test_font = ImageFont.load_default()
+    artist_block = create_single_text_block(artist)
+    title_block = create_single_text_block(title)
 
-            try:
-                temp_img = Image.new('RGB', (2000, 1000), (255, 255, 255))
-                temp_draw = ImageDraw.Draw(temp_img)
-                bbox = temp_draw.textbbox((0, 0), text, font=test_font)
-                text_w = bbox[2] - bbox[0]
-                text_h = bbox[3] - bbox[1]
-
-                if text_w > 0 and text_h > 0:
-                    best_font = test_font
-                    best_text_w = text_w
-                    best_text_h = text_h
-                    break
-            except Exception as e:
-                print(f"Ошибка с шрифтом размера {font_size}: {e}")
-                pass
+    return artist_block, title_block
 
-            font_size -= 10
+# Холст 1x1 только для измерения многострочного текста
+_measure_draw = ImageDraw.Draw(Image.new('L', (1, 1)))
 
-        if best_font and best_text_w > 0 and best_text_h > 0:
-            # Добавляем больше отступов для предотвращения обрезания
-            margin_x = 60
-            margin_y = 80  # Увеличенный отступ по вертикали
+@lru_cache(maxsize=TEXT_BLOCK_CACHE_SIZE)
+def render_text_block(text, width, height):
+    """
+    Блок текста, растянутый до width x height. Размер шрифта подбирается по font.getbbox
+    без промежуточных изображений; результат запоминается (не изменять!)
+    """
+    font_size = 200
+    best_font = None
+    best_text_w = 0
+    best_text_h = 0
 
-            temp_img = Image.new('RGB', (best_text_w + margin_x, best_text_h + margin_y), (255, 255, 255))
-            temp_draw = ImageDraw.Draw(temp_img)
+    while font_size > 20:
+        test_font = load_font(font_size)
+        if test_font is None:
+            test_font = ImageFont.load_default()
 
-            # Рисуем текст с увеличенными отступами
-            temp_draw.text((margin_x // 2, margin_y // 2), text, fill=(0, 0, 0), font=best_font)
+        try:
+            if '\n' in text:
+                # Многострочный текст меряем так же, как его нарисует ImageDraw.text
+                bbox = _measure_draw.multiline_textbbox((0, 0), text, font=test_font)
+            else:
+                bbox = test_font.getbbox(text)
+            text_w = bbox[2] - bbox[0]
+            text_h = bbox[3] - bbox[1]
 
-            # Растягиваем до нужного размера
-            stretched_text = temp_img.resize((TEXT_BLOCK_WIDTH, TEXT_LINE_HEIGHT), Image.Resampling.LANCZOS)
+            if text_w > 0 and text_h > 0:
+                best_font = test_font
+                best_text_w = text_w
+                best_text_h = text_h
+                break
+        except Exception as e:
+            print(f"Ошибка с шрифтом размера {font_size}: {e}")
+            pass
 
-            print(f"Блок '{text}' создан: {best_text_w}x{best_text_h} -> {TEXT_BLOCK_WIDTH}x{TEXT_LINE_HEIGHT}")
-            return stretched_text
-        else:
-            # Fallback с увеличенными отступами
-            fallback_img = Image.new('RGB', (TEXT_BLOCK_WIDTH, TEXT_LINE_HEIGHT), (255, 255, 255))
-            fallback_draw = ImageDraw.Draw(fallback_img)
-            fallback_font = load_font(50)
-            if fallback_font is None:
-                fallback_font = ImageFont.load_default()
-            fallback_draw.text((20, TEXT_LINE_HEIGHT // 2 - 40), text, fill=(0, 0, 0), font=fallback_font)
-            return fallback_img
+        font_size -= 10
 
-    artist_block = create_single_text_block(artist)
-    title_block = create_single_text_block(title)
+    if best_font and best_text_w > 0 and best_text_h > 0:
+        # Добавляем больше отступов для предотвращения обрезания
+        margin_x = 60
+        margin_y = 80  # Увеличенный отступ по вертикали
 
-    return artist_block, title_block
+        temp_img = Image.new('RGB', (best_text_w + margin_x, best_text_h + margin_y), (255, 255, 255))
+        temp_draw = ImageDraw.Draw(temp_img)
+
+        # Рисуем текст с увеличенными отступами
+        temp_draw.text((margin_x // 2, margin_y // 2), text, fill=(0, 0, 0), font=best_font)
+
+        # Растягиваем до нужного размера
+        stretched_text = temp_img.resize((width, height), Image.Resampling.LANCZOS)
+
+        print(f"Блок '{text}' создан: {best_text_w}x{best_text_h} -> {width}x{height}")
+        return stretched_text
+    else:
+        # Fallback с увеличенными отступами
+        fallback_img = Image.new('RGB', (width, height), (255, 255, 255))
+        fallback_draw = ImageDraw.Draw(fallback_img)
+        fallback_font = load_font(50)
+        if fallback_font is None:
+            fallback_font = ImageFont.load_default()
+        fallback_draw.text((20, height // 2 - 40), text, fill=(0, 0, 0), font=fallback_font)
+        return fallback_img
 
 def calculate_fade_in_progress(current_time, bpm, beats_per_loop=BEATS_PER_LOOP):
     """
@@ -158,30 +201,121 @@ def calculate_fade_in_progress(current_time, bpm, beats_per_loop=BEATS_PER_LOOP)
 
     return current_time / fade_duration
 
+def fade_in_alpha(fade_progress):
+    """
+    Непрозрачность элемента (0 - не виден, 255 - виден полностью) для прогресса выплывания
+    """
+    if fade_progress >= 1.0:
+        return 255
+    return max(0, int(fade_progress * 255))
+
+@lru_cache(maxsize=256)
+def fade_in_lut(alpha):
+    """
+    Таблица из 256 значений для смешивания с белым фоном с непрозрачностью alpha
+    (целочисленно, с тем же округлением, что и Image.alpha_composite)
+    """
+    levels = np.arange(256, dtype=np.int64)
+    return ((levels * alpha + 255 * (255 - alpha) + 127) // 255).astype(np.uint8)
+
 def apply_fade_in_effect(img, fade_progress):
     """
     Применяет эффект выплывания из белого фона
     """
-    if fade_progress >= 1.0:
+    alpha = fade_in_alpha(fade_progress)
+    if alpha >= 255:
         return img
 
-    # Создаем белый фон того же размера
-    white_bg = Image.new('RGB', img.size, (255, 255, 255))
+    return img.point(list(fade_in_lut(alpha)) * len(img.getbands()))
+
+class RenderProfile(namedtuple('RenderProfile', ['name', 'width', 'height', 'fps'])):
+    """
+    Профиль рендера: размер кадра и частота кадров. Размеры слоев из settings.py
+    заданы для кадра 1920x1080 и масштабируются пропорционально высоте кадра
+    """
+
+    @property
+    def scale(self):
+        return self.height / 1080
+
+    def px(self, value):
+        """
+        Размер из settings.py (в пикселях кадра 1080p) в пикселях профиля
+        """
+        return max(1, int(round(value * self.scale)))
 
-    # Смешиваем изображение с белым фоном
-    alpha = int(fade_progress * 255)
+    @property
+    def main_size(self):
+        return self.px(1080)
 
-    # Конвертируем в RGBA для альфа-смешивания
-    img_rgba = img.convert('RGBA')
-    white_rgba = white_bg.convert('RGBA')
+    @property
+    def vis_width(self):
+        return self.px(VISUALIZATION_WIDTH)
 
-    # Создаем маску альфа-канала
-    alpha_mask = Image.new('L', img.size, alpha)
-    img_rgba.putalpha(alpha_mask)
+    @property
+    def waveform_height(self):
+        return self.px(VISUALIZATION_HEIGHT_WAVEFORM)
 
-    # Смешиваем
-    result = Image.alpha_composite(white_rgba.convert('RGBA'), img_rgba)
-    return result.convert('RGB')
+    @property
+    def spectrum_height(self):
+        return self.px(VISUALIZATION_HEIGHT_SPECTRUM)
+
+    @property
+    def gif_width(self):
+        return self.px(GIF_BASE_WIDTH)
+
+    @property
+    def text_size(self):
+        return self.px(TEXT_BLOCK_WIDTH), self.px(TEXT_LINE_HEIGHT)
+
+def get_render_profile(name=RENDER_PROFILE):
+    """
+    Профиль рендера по имени из RENDER_PROFILES
+    """
+    if name not in RENDER_PROFILES:
+        raise ValueError(f"Неизвестный профиль рендера: {name}")
+    width, height, fps = RENDER_PROFILES[name]
+    return RenderProfile(name, width, height, fps)
+
+@lru_cache(maxsize=1024)
+def compute_layout(profile, main_size, vis_width=None, spectrum_height=None, waveform_height=None,
+                   gif_height=None, text_size=None):
+    """
+    Позиции (x, y) всех слоев кадра профиля для данных размеров
+    (отступы из кадра 1920x1080 масштабируются вместе с профилем)
+    """
+    vis_width = vis_width if vis_width is not None else profile.vis_width
+    spectrum_height = spectrum_height if spectrum_height is not None else profile.spectrum_height
+    waveform_height = waveform_height if waveform_height is not None else profile.waveform_height
+    text_size = text_size if text_size is not None else profile.text_size
+    if gif_height is None:
+        gif_height = waveform_height
+
+    width, height = profile.width, profile.height
+    gap = profile.px(20)
+    layout = {'main': ((width - main_size) // 2, (height - main_size) // 2)}
+
+    # Визуализации слева, по центру экрана по вертикали
+    total_height = spectrum_height + gap + waveform_height + gap + gif_height
+    center_screen = height // 2
+    vis_x = gap
+    current_y = center_screen - (total_height // 2)
+    layout['spectrum'] = (vis_x, current_y)
+    current_y += spectrum_height + gap
+    layout['waveform'] = (vis_x, current_y)
+    current_y += waveform_height + gap
+    layout['gif'] = (vis_x, current_y)
+
+    # Текст справа (низ видео = начало координат)
+    text_width, text_height = text_size
+    line_height = profile.text_size[1]
+    text_x = width - text_width - gap
+    artist_center_y_from_bottom = profile.px(145) + line_height // 2
+    title_center_y_from_bottom = profile.px(935) - line_height // 2
+    layout['artist'] = (text_x, height - artist_center_y_from_bottom - text_height // 2)
+    layout['title'] = (text_x, height - title_center_y_from_bottom - text_height // 2)
+
+    return layout
 
 def apply_group_shake_effect(base_size, amplitude, group_type="default"):
     """
@@ -201,163 +335,411 @@ def apply_group_shake_effect(base_size, amplitude, group_type="default"):
 
     return new_size, size_multiplier
 
-def create_waveform_visualization(audio_data, current_time, sample_rate, width=VISUALIZATION_WIDTH,
-                                height=VISUALIZATION_HEIGHT_WAVEFORM):
-    img = Image.new('RGB', (width, height), (255, 255, 255))
-    draw = ImageDraw.Draw(img)
+def rasterize_columns(top, bottom, height, width):
+    """
+    Панель (height, width) uint8: в столбце x черным (0) закрашены строки от top[x] до bottom[x]
+    включительно, остальное белое (255). Столбцы за пределами массивов остаются пустыми
+    """
+    column_top = np.full(width, height, dtype=np.int64)
+    column_bottom = np.full(width, -1, dtype=np.int64)
+    count = min(len(top), width)
+    column_top[:count] = top[:count]
+    column_bottom[:count] = bottom[:count]
 
-    window_size = 2.0
+    rows = np.arange(height)[:, np.newaxis]
+    background = (rows < column_top) | (rows > column_bottom)
+    return background.view(np.uint8) * np.uint8(255)
+
+def waveform_window(audio_data, current_time, sample_rate, width=VISUALIZATION_WIDTH):
+    """
+    Отсчеты волны вокруг текущего момента, прореженные до ширины панели
+    """
     current_sample = int(current_time * sample_rate)
-    window_samples = int(window_size * sample_rate)
+    window_samples = int(WAVEFORM_WINDOW * sample_rate)
+
+    start_sample = max(0, current_sample - window_samples // 2)
+    end_sample = min(len(audio_data), current_sample + window_samples // 2)
+
+    if end_sample <= start_sample:
+        return audio_data[:0]
+
+    waveform_data = audio_data[start_sample:end_sample]
+    if len(waveform_data) > width:
+        step = len(waveform_data) // width
+        waveform_data = waveform_data[::step][:width]
+
+    return waveform_data
+
+def column_peaks(samples, start, step, columns, end):
+    """
+    Точные минимум и максимум отсчетов для столбцов [start + i*step, start + (i+1)*step), i < columns
+    (не дальше end): один проход reduceat по окну
+    """
+    bounds = np.minimum(start + np.arange(columns + 1, dtype=np.int64) * step, end)
+    window = samples[bounds[0]:bounds[-1]]
+    offsets = bounds[:-1] - bounds[0]
+    return np.minimum.reduceat(window, offsets), np.maximum.reduceat(window, offsets)
+
+def waveform_peaks(audio_data, current_sample, sample_rate, width=VISUALIZATION_WIDTH):
+    """
+    Пиковая амплитуда столбцов волны в окне вокруг отсчета current_sample - то же окно и те же
+    столбцы, что у waveform_window, но столбец - максимум модуля всех его отсчетов, а не каждый
+    step-й отсчет, поэтому транзиенты не теряются
+    """
+    window_samples = int(WAVEFORM_WINDOW * sample_rate)
 
     start_sample = max(0, current_sample - window_samples // 2)
     end_sample = min(len(audio_data), current_sample + window_samples // 2)
+    length = end_sample - start_sample
+    if length <= 0:
+        return np.zeros(0, dtype=np.float32)
 
-    if end_sample > start_sample:
-        waveform_data = audio_data[start_sample:end_sample]
+    step = length // width if length > width else 1
+    columns = min(width, -(-length // step))
+    mins, maxs = column_peaks(audio_data, start_sample, step, columns, end_sample)
+    return np.maximum(maxs, -mins)
 
-        if len(waveform_data) > width:
-            step = len(waveform_data) // width
-            waveform_data = waveform_data[::step][:width]
+def resample_columns(values, width):
+    """
+    Значения столбцов панели, пересчитанные на width столбцов линейной интерполяцией
+    """
+    values = np.asarray(values, dtype=np.float32)
+    if len(values) in (0, width):
+        return values
+    positions = np.linspace(0, len(values) - 1, width)
+    return np.interp(positions, np.arange(len(values)), values).astype(np.float32)
+
+def rasterize_waveform(waveform_data, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_WAVEFORM):
+    """
+    Черно-белая панель волны (height, width) uint8 без центральной линии
+    """
+    return rasterize_waveform_offsets(waveform_offsets(waveform_data, height), width, height)
 
-        center_y = height // 2
+def waveform_offsets(waveform_data, height=VISUALIZATION_HEIGHT_WAVEFORM):
+    """
+    Половина высоты столбца волны (от центра панели) для каждого отсчета
+    """
+    return np.abs((np.asarray(waveform_data) * (height // 2) * 0.8).astype(np.int64))
 
-        for i, sample in enumerate(waveform_data):
-            y_offset = int(sample * center_y * 0.8)
-            y1 = center_y - y_offset
-            y2 = center_y + y_offset
-            draw.line([(i, y1), (i, y2)], fill=(0, 0, 0), width=1)
+def rasterize_waveform_offsets(y_offset, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_WAVEFORM):
+    center_y = height // 2
+    y_offset = np.asarray(y_offset, dtype=np.int64)
+    return rasterize_columns(center_y - y_offset, center_y + y_offset, height, width)
 
+def waveform_playhead_columns(width=VISUALIZATION_WIDTH):
+    """
+    Столбцы центральной красной линии (линия толщиной 2 пикселя, как рисует ImageDraw)
+    """
     center_x = width // 2
-    draw.line([(center_x, 0), (center_x, height)], fill=(255, 0, 0), width=2)
+    return slice(center_x, min(center_x + 2, width))
 
+def draw_waveform(waveform_data, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_WAVEFORM):
+    """
+    Рисует волну с центральной красной линией
+    """
+    img = Image.fromarray(rasterize_waveform(waveform_data, width, height)).convert('RGB')
+    playhead = waveform_playhead_columns(width)
+    if playhead.stop > playhead.start:
+        img.paste((255, 0, 0), (playhead.start, 0, playhead.stop, height))
     return img
 
-def create_spectrum_visualization(audio_data, current_time, sample_rate, width=VISUALIZATION_WIDTH,
-                                height=VISUALIZATION_HEIGHT_SPECTRUM):
-    img = Image.new('RGB', (width, height), (255, 255, 255))
-    draw = ImageDraw.Draw(img)
+def create_waveform_visualization(audio_data, current_time, sample_rate, width=VISUALIZATION_WIDTH,
+                                height=VISUALIZATION_HEIGHT_WAVEFORM):
+    waveform_data = waveform_window(audio_data, current_time, sample_rate, width)
+    return draw_waveform(waveform_data, width, height)
 
-    # Увеличиваем размер окна для лучшего частотного разрешения
-    window_samples = int(0.2 * sample_rate)  # Увеличено с 0.1 до 0.2
-    current_sample = int(current_time * sample_rate)
+def _gaussian_kernel(sigma, truncate=4.0):
+    """
+    Ядро гауссова фильтра (совпадает с ядром scipy.ndimage.gaussian_filter1d)
+    """
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / (sigma * sigma) * x ** 2)
+    return kernel / kernel.sum()
+
+_SPECTRUM_KERNEL = _gaussian_kernel(SPECTRUM_SMOOTHING_SIGMA)
+_log_remap_cache = {}
+
+def _log_remap_indices(n_bins, width):
+    """
+    Индексы и веса линейной интерполяции для логарифмического распределения частот.
+    Строятся один раз на пару (n_bins, width)
+    """
+    key = (n_bins, width)
+    if key not in _log_remap_cache:
+        # Больше деталей в низких частотах, где обычно больше энергии
+        log_indices = np.logspace(0, np.log10(n_bins - 1), width * 2)
+        # Берем каждый второй элемент для финального массива
+        log_indices = log_indices[::2][:width]
+        left = np.minimum(np.floor(log_indices).astype(np.int64), n_bins - 1)
+        right = np.minimum(left + 1, n_bins - 1)
+        fraction = log_indices - left
+        _log_remap_cache[key] = (left, right, fraction)
+    return _log_remap_cache[key]
+
+def _spectrum_display(fft, width):
+    """
+    Превращает модули спектров (n, bins) в нормализованные значения для отображения (n, width).
+    Нормализация, сглаживание и логарифмическое распределение выполняются для всех строк сразу.
+    По ширине откладываются все полосы до частоты Найквиста анализа (ANALYSIS_SAMPLE_RATE / 2)
+    """
+    # Улучшенная обработка с защитой от нулевых значений
+    fft_db = 20 * np.log10(np.maximum(fft, 1e-12))
+
+    # Используем медиану и MAD (Median Absolute Deviation) для стабильной нормализации
+    median_db = np.median(fft_db, axis=1, keepdims=True)
+    mad = np.median(np.abs(fft_db - median_db), axis=1, keepdims=True)
+    min_db = median_db - 3 * mad
+    max_db = median_db + 4 * mad  # Чуть больше места для пиков
+
+    # Альтернативно используем процентили и выбираем более консервативные границы
+    percentile_min, percentile_max = np.percentile(fft_db, [2, 98], axis=1, keepdims=True)
+    final_min = np.minimum(min_db, percentile_min)
+    final_max = np.maximum(max_db, percentile_max)
+
+    # Расширяем диапазон на 20% сверху и 10% снизу для предотвращения обрезания
+    db_range = final_max - final_min
+    extended_min = final_min - db_range * 0.1
+    extended_max = final_max + db_range * 0.2
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fft_normalized = (fft_db - extended_min) / (extended_max - extended_min)
+        # Применяем сигмоидальное ограничение вместо жесткого clip
+        fft_normalized = 1 / (1 + np.exp(-6 * (fft_normalized - 0.5)))
+    fft_normalized = np.where(db_range > 0, fft_normalized, 0.5)
+
+    # Двухэтапное сглаживание
+    if fft_normalized.shape[1] > 5:
+        fft_normalized = ndimage.correlate1d(fft_normalized, _SPECTRUM_KERNEL, axis=1, mode='reflect')
+        # Дополнительное медианное сглаживание для устранения выбросов
+        fft_normalized = ndimage.median_filter(fft_normalized, size=(1, 3), mode='reflect')
+
+    n_bins = fft_normalized.shape[1]
+    if n_bins <= width:
+        return fft_normalized
+
+    left, right, fraction = _log_remap_indices(n_bins, width)
+    return fft_normalized[:, left] + (fft_normalized[:, right] - fft_normalized[:, left]) * fraction
+
+def spectrum_fft_size(window_length, sample_rate):
+    """
+    Размер FFT для окна: не меньше SPECTRUM_MIN_FFT, пересчитанного с AUDIO_SAMPLE_RATE
+    на частоту анализа (разрешение по частоте не зависит от частоты анализа)
+    """
+    min_fft = max(1, int(round(SPECTRUM_MIN_FFT * sample_rate / AUDIO_SAMPLE_RATE)))
+    return max(min_fft, window_length)
 
+def _spectrum_row(window_data, width, sample_rate=ANALYSIS_SAMPLE_RATE):
+    """
+    Нормализованный спектр одного окна аудио (None, если окно пустое)
+    """
+    if len(window_data) == 0:
+        return None
+
+    # Применяем окно Хэмминга для уменьшения спектральных утечек
+    windowed = window_data * np.hamming(len(window_data))
+
+    # Увеличиваем размер FFT для лучшего разрешения
+    n_fft = spectrum_fft_size(len(windowed), sample_rate)
+    fft = np.abs(np.fft.rfft(windowed, n=n_fft))
+
+    return _spectrum_display(fft[np.newaxis, :], width)[0]
+
+def _spectrum_window_bounds(current_sample, window_samples, total_samples):
     start_sample = max(0, current_sample - window_samples // 2)
-    end_sample = min(len(audio_data), current_sample + window_samples // 2)
+    end_sample = min(total_samples, current_sample + window_samples // 2)
+    return start_sample, end_sample
 
-    if end_sample > start_sample:
-        window_data = audio_data[start_sample:end_sample]
-
-        # Применяем окно Хэмминга для уменьшения спектральных утечек
-        windowed = window_data * np.hamming(len(window_data))
-
-        # Увеличиваем размер FFT для лучшего разрешения
-        n_fft = max(2048, len(windowed))
-        fft = np.abs(np.fft.rfft(windowed, n=n_fft))
-
-        if len(fft) > 0:
-            # Улучшенная обработка с защитой от нулевых значений
-            fft_safe = np.maximum(fft, 1e-12)  # Более консервативная защита
-            fft_db = 20 * np.log10(fft_safe)
-
-            # Более точная адаптивная нормализация
-            # Используем медиану для более стабильной нормализации
-            median_db = np.median(fft_db)
-            mad = np.median(np.abs(fft_db - median_db))  # Median Absolute Deviation
-
-            # Определяем диапазон на основе медианы и MAD
-            min_db = median_db - 3 * mad
-            max_db = median_db + 4 * mad  # Чуть больше места для пиков
-
-            # Альтернативно используем процентили с большим запасом
-            percentile_min = np.percentile(fft_db, 2)   # 2-й процентиль
-            percentile_max = np.percentile(fft_db, 98)  # 98-й процентиль
-
-            # Выбираем более консервативные границы
-            final_min = min(min_db, percentile_min)
-            final_max = max(max_db, percentile_max)
-
-            # Добавляем дополнительный запас для предотвращения обрезания
-            db_range = final_max - final_min
-            if db_range > 0:
-                # Расширяем диапазон на 20% сверху и 10% снизу
-                extended_min = final_min - db_range * 0.1
-                extended_max = final_max + db_range * 0.2
-
-                # Нормализуем в диапазон [0, 1] с мягким ограничением
-                fft_normalized = (fft_db - extended_min) / (extended_max - extended_min)
-                # Применяем сигмоидальное ограничение вместо жесткого clip
-                fft_normalized = 1 / (1 + np.exp(-6 * (fft_normalized - 0.5)))
-            else:
-                fft_normalized = np.full_like(fft_db, 0.5)
+def frame_times(n_frames, fps):
+    """
+    Моменты времени кадров, как их перебирает moviepy (i * (1 / fps))
+    """
+    return np.arange(n_frames) * (1.0 / fps)
 
-            # Улучшенное сглаживание
-            if len(fft_normalized) > 5:
-                try:
-                    from scipy import ndimage
-                    # Применяем двухэтапное сглаживание
-                    fft_normalized = ndimage.gaussian_filter1d(fft_normalized, sigma=0.8)
-                    # Дополнительное медианное сглаживание для устранения выбросов
-                    fft_normalized = ndimage.median_filter(fft_normalized, size=3)
-                except ImportError:
-                    # Простое скользящее среднее если scipy недоступна
-                    kernel_size = 3
-                    kernel = np.ones(kernel_size) / kernel_size
-                    fft_normalized = np.convolve(fft_normalized, kernel, mode='same')
-
-            # Подготовка данных для отображения с логарифмическим распределением
-            if len(fft_normalized) > width:
-                # Улучшенное логарифмическое распределение частот
-                # Больше деталей в низких частотах, где обычно больше энергии
-                log_indices = np.logspace(0, np.log10(len(fft_normalized) - 1), width * 2)
-                # Применяем дополнительную интерполацию для сглаживания
-                fft_interpolated = np.interp(log_indices, np.arange(len(fft_normalized)), fft_normalized)
-                # Берем каждый второй элемент для финального массива
-                fft_display = fft_interpolated[::2][:width]
-            else:
-                fft_display = fft_normalized
+def frame_centers(first_frame, last_frame, fps, sample_rate):
+    """
+    Отсчеты, соответствующие кадрам [first_frame, last_frame) (те же значения, что int(t * sample_rate))
+    """
+    return (np.arange(first_frame, last_frame) * (1.0 / fps) * sample_rate).astype(np.int64)
 
-            # Рисуем спектр с улучшенным отображением
-            for i, magnitude in enumerate(fft_display):
-                # Используем нелинейное масштабирование для лучшей видимости
-                # Применяем степенную функцию для выделения пиков
-                enhanced_magnitude = np.power(magnitude, 0.7)  # Корень для выделения слабых сигналов
+def frame_index_at(t, fps):
+    """
+    Номер кадра для момента времени t (устойчиво к погрешностям float)
+    """
+    return int(round(t * fps))
 
-                # Вычисляем высоту с гарантированным минимумом и максимумом
-                bar_height = max(int(enhanced_magnitude * height * 0.98), 1)
-                bar_height = min(bar_height, height - 1)  # Гарантируем что не выходим за границы
+def compute_spectrum_frames(audio_data, sample_rate, fps, n_frames, width=VISUALIZATION_WIDTH,
+                            batch_size=SPECTRUM_BATCH_SIZE, centers=None):
+    """
+    Вычисляет спектры всех кадров трека заранее: пакетное FFT по окнам вокруг каждого кадра,
+    нормализация, сглаживание и логарифмическое распределение частот.
+    Возвращает массив float32 (n_frames, width); строки кадров без аудио заполнены NaN.
+    centers - отсчеты кадров внутри audio_data, если это не весь трек с нулевого кадра
+    """
+    spectrum = np.full((n_frames, width), np.nan, dtype=np.float32)
+    if n_frames <= 0 or len(audio_data) == 0:
+        return spectrum
+
+    total_samples = len(audio_data)
+    window_samples = int(SPECTRUM_WINDOW * sample_rate)
+    full_length = 2 * (window_samples // 2)
+    if centers is None:
+        centers = frame_centers(0, n_frames, fps, sample_rate)
+
+    starts = centers - window_samples // 2
+    full = (starts >= 0) & (centers + window_samples // 2 <= total_samples)
+
+    # Кадры у краев трека получают укороченное окно - считаем их по одному
+    for i in np.flatnonzero(~full):
+        start_sample, end_sample = _spectrum_window_bounds(int(centers[i]), window_samples, total_samples)
+        if end_sample > start_sample:
+            spectrum[i] = _spectrum_row(audio_data[start_sample:end_sample], width, sample_rate)
+
+    if full_length == 0:
+        return spectrum
+
+    full_indices = np.flatnonzero(full)
+    if len(full_indices) == 0:
+        return spectrum
+
+    # Окно Хэмминга и размер FFT общие для всех полных окон
+    window = np.hamming(full_length)
+    n_fft = spectrum_fft_size(full_length, sample_rate)
+    windows = np.lib.stride_tricks.sliding_window_view(audio_data, full_length)
+
+    for batch_start in range(0, len(full_indices), batch_size):
+        batch = full_indices[batch_start:batch_start + batch_size]
+        segments = windows[starts[batch]] * window
+        fft = np.abs(np.fft.rfft(segments, n=n_fft, axis=1))
+        spectrum[batch] = _spectrum_display(fft, width)
+
+    return spectrum
+
+def spectrum_bar_heights(fft_display, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_SPECTRUM):
+    """
+    Высота закрашенной части каждого столбца панели спектра (0 - пустой столбец)
+    """
+    column_heights = np.zeros(width, dtype=np.int64)
+    if fft_display is None or len(fft_display) == 0 or np.isnan(fft_display[0]):
+        return column_heights
 
-                # Рисуем от низа вверх с дополнительной толщиной для лучшей видимости
-                y_start = height - 1
-                y_end = height - bar_height
+    # Нелинейное масштабирование: корень выделяет слабые сигналы
+    enhanced_magnitude = np.power(fft_display, 0.7)
 
-                # Рисуем линию с переменной толщиной в зависимости от амплитуды
-                line_width = max(1, int(enhanced_magnitude * 2))
+    # Высота с гарантированным минимумом и без выхода за границы
+    bar_heights = np.clip((enhanced_magnitude * height * 0.98).astype(np.int64), 1, height - 1)
 
-                for w in range(line_width):
-                    if i + w < width:
-                        draw.line([(i + w, y_start), (i + w, y_end)], fill=(0, 0, 0), width=1)
+    # Толщина линии зависит от амплитуды: столбец i закрашивает столбцы i .. i + line_width - 1
+    line_widths = np.maximum(1, (enhanced_magnitude * 2).astype(np.int64))
+    bars = np.arange(len(bar_heights))
 
-    return img
+    for offset in range(int(line_widths.max())):
+        selected = (line_widths > offset) & (bars + offset < width)
+        columns = bars[selected] + offset
+        column_heights[columns] = np.maximum(column_heights[columns], bar_heights[selected])
+
+    return column_heights
+
+def rasterize_spectrum(fft_display, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_SPECTRUM):
+    """
+    Черно-белая панель спектра (height, width) uint8: столбцы растут от низа панели
+    """
+    return rasterize_bars(spectrum_bar_heights(fft_display, width, height), height)
+
+def rasterize_bars(column_heights, height):
+    """
+    Панель (height, len(column_heights)) uint8 со столбцами заданной высоты от низа панели
+    """
+    rows = np.arange(height)[:, np.newaxis]
+    return (rows < height - np.asarray(column_heights, dtype=np.int64)).view(np.uint8) * np.uint8(255)
+
+def draw_spectrum(fft_display, width=VISUALIZATION_WIDTH, height=VISUALIZATION_HEIGHT_SPECTRUM):
+    """
+    Рисует столбцы спектра по нормализованным значениям
+    """
+    return Image.fromarray(rasterize_spectrum(fft_display, width, height)).convert('RGB')
+
+def spectrum_display_at(audio_data, current_time, sample_rate, width=VISUALIZATION_WIDTH):
+    """
+    Нормализованный спектр одного кадра без предварительного расчета
+    (для размеров, отличных от рассчитанных заранее)
+    """
+    window_samples = int(SPECTRUM_WINDOW * sample_rate)
+    current_sample = int(current_time * sample_rate)
+    start_sample, end_sample = _spectrum_window_bounds(current_sample, window_samples, len(audio_data))
+
+    if end_sample <= start_sample:
+        return None
+    return _spectrum_row(audio_data[start_sample:end_sample], width, sample_rate)
+
+def create_spectrum_visualization(audio_data, current_time, sample_rate, width=VISUALIZATION_WIDTH,
+                                height=VISUALIZATION_HEIGHT_SPECTRUM):
+    fft_display = spectrum_display_at(audio_data, current_time, sample_rate, width)
+    return draw_spectrum(fft_display, width, height)
+
+def compute_amplitude_envelope(audio_data, sample_rate, fps, n_frames, window_size=AMPLITUDE_WINDOW,
+                               mode=AMPLITUDE_MODE, centers=None):
+    """
+    Вычисляет огибающую амплитуды для всех кадров за один проход по уже декодированному аудио.
+    Для каждого кадра берется окно window_size секунд вокруг момента t = i / fps
+    (mode='peak' - пиковое значение, mode='rms' - среднеквадратичное).
+    centers - отсчеты кадров внутри audio_data, если это не весь трек с нулевого кадра
+    """
+    if n_frames <= 0:
+        return np.zeros(0, dtype=np.float32)
+
+    half_window = max(1, int(window_size * sample_rate / 2))
+    samples = np.abs(np.asarray(audio_data, dtype=np.float32))
+    if mode == "rms":
+        samples = samples * samples
+
+    # Дополняем нулями, чтобы окна на краях не выходили за пределы массива
+    padded = np.pad(samples, (half_window, half_window + 1))
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * half_window)
+
+    if centers is None:
+        centers = frame_centers(0, n_frames, fps, sample_rate)
+    centers = np.clip(centers, 0, len(samples))
+    frame_windows = windows[centers]
+
+    if mode == "rms":
+        # Нормируем на реальную длину окна, обрезанного границами трека
+        starts = np.maximum(centers - half_window, 0)
+        ends = np.minimum(centers + half_window, len(samples))
+        lengths = np.maximum(ends - starts, 1)
+        envelope = np.sqrt(frame_windows.sum(axis=1) / lengths)
+    else:
+        envelope = frame_windows.max(axis=1)
+
+    return np.minimum(envelope, 1.0).astype(np.float32)
 
 def smooth_amplitudes(amplitudes, window_size=SMOOTHING_WINDOW_SIZE):
-    smoothed = []
-    for i in range(len(amplitudes)):
-        start = max(0, i - window_size // 2)
-        end = min(len(amplitudes), i + window_size // 2 + 1)
-        window = amplitudes[start:end]
-        smoothed.append(sum(window) / len(window))
-    return smoothed
+    """
+    Скользящее среднее с центрированным окном (на краях окно укорачивается)
+    """
+    values = np.asarray(amplitudes, dtype=np.float64)
+    count = len(values)
+    if count == 0:
+        return values
 
-def apply_exponential_smoothing(amplitudes, alpha=SMOOTHING_ALPHA):
-    if not amplitudes:
-        return amplitudes
+    half = window_size // 2
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+    indices = np.arange(count)
+    starts = np.maximum(0, indices - half)
+    ends = np.minimum(count, indices + half + 1)
 
-    smoothed = [amplitudes[0]]
-    for i in range(1, len(amplitudes)):
-        smoothed_value = alpha * amplitudes[i] + (1 - alpha) * smoothed[i - 1]
-        smoothed.append(smoothed_value)
+    return (cumulative[ends] - cumulative[starts]) / (ends - starts)
 
+def apply_exponential_smoothing(amplitudes, alpha=SMOOTHING_ALPHA):
+    """
+    Экспоненциальное сглаживание: y[i] = alpha * x[i] + (1 - alpha) * y[i - 1], y[0] = x[0]
+    """
+    values = np.asarray(amplitudes, dtype=np.float64)
+    if len(values) == 0:
+        return values
+
+    # Начальное состояние фильтра подобрано так, чтобы y[0] = x[0]
+    smoothed, _ = lfilter([alpha], [1.0, alpha - 1.0], values, zi=[(1 - alpha) * values[0]])
     return smoothed
 
 def calculate_gif_timing(bpm, beats_per_loop=BEATS_PER_LOOP):
@@ -391,12 +773,10 @@ def resize_gif_frame(frame, target_width=GIF_BASE_WIDTH):
 
     return frame.resize((target_width, target_height), Image.Resampling.LANCZOS)
 
-def load_gif_frames(target_width=GIF_BASE_WIDTH):
+def load_gif_frames(target_width=GIF_BASE_WIDTH, gif_path=GIF_FILE):
     """
     Загружает фиксированный GIF файл из настроек
     """
-    gif_path = GIF_FILE
-
     if not os.path.exists(gif_path):
         print(f"GIF файл {gif_path} не найден!")
         return []
@@ -437,192 +817,1849 @@ def load_gif_frames(target_width=GIF_BASE_WIDTH):
 
     return frames
 
-def create_audio_visualizer(audio_path, image_path, output_path, bpm=BPM, beats_per_loop=BEATS_PER_LOOP):
-    print("Загружаю аудио для визуализаций...")
-    audio_mono, sr = librosa.load(audio_path, sr=AUDIO_SAMPLE_RATE, mono=True)
+def file_digest(path):
+    """
+    SHA-256 содержимого файла
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@contextlib.contextmanager
+def atomic_file(path):
+    """
+    Временный файл для записи рядом с path; после успешной записи он переименовывается в path,
+    при ошибке удаляется. Имя выдает mkstemp, поэтому потоки одного процесса тоже не пересекаются
+    """
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+def save_npy_atomic(path, array):
+    """
+    Сохраняет массив в .npy через временный файл, чтобы параллельные процессы
+    никогда не видели частично записанный файл
+    """
+    with atomic_file(path) as f:
+        np.save(f, array)
 
-    artist, title = get_audio_metadata(audio_path)
-    print(f"Исполнитель: {artist}")
-    print(f"Название: {title}")
-    print(f"Качество аудио: {sr} Гц")
+_gif_atlas_cache = {}
+
+def load_gif_atlas(target_width=GIF_BASE_WIDTH, gif_path=GIF_FILE, cache_dir=CACHE_DIR):
+    """
+    Кадры GIF в виде непрерывного массива яркости uint8 (n_frames, H, W).
+    GIF декодируется один раз: атлас сохраняется в .npy (ключ - хэш файла и ширина)
+    и открывается через memmap только для чтения, поэтому параллельные рендеры делят одни страницы памяти
+    """
+    if not os.path.exists(gif_path):
+        print(f"GIF файл {gif_path} не найден!")
+        return np.zeros((0, 0, 0), dtype=np.uint8)
 
-    # Создаем обложку
-    thumbnail_path = output_path.replace('.mp4', '_thumbnail.jpg')
-    create_thumbnail(image_path, thumbnail_path)
+    digest = file_digest(gif_path)
+    key = (digest, target_width)
+    if key in _gif_atlas_cache:
+        return _gif_atlas_cache[key]
 
-    # Создаем отдельные блоки текста
-    artist_block, title_block = create_text_blocks(artist, title)
+    atlas_path = os.path.join(cache_dir, f"gif_atlas_v{GIF_ATLAS_VERSION}_{digest[:16]}_{target_width}.npy")
+    if not os.path.exists(atlas_path):
+        frames = load_gif_frames(target_width, gif_path)
+        atlas = np.stack([np.asarray(luminance_image(frame)) for frame in frames])
+        save_npy_atomic(atlas_path, atlas)
 
-    gif_loop_duration = calculate_gif_timing(bpm, beats_per_loop)
+    atlas = np.load(atlas_path, mmap_mode='r')
+    _gif_atlas_cache[key] = atlas
+    return atlas
 
-    audio_clip = AudioFileClip(audio_path)
-    duration = audio_clip.duration
-    fps = 30
+def resize_plane(plane, size):
+    """
+    Масштабирует плоскость яркости до size = (ширина, высота)
+    """
+    if (plane.shape[1], plane.shape[0]) == size:
+        return plane
+    return np.asarray(Image.fromarray(plane).resize(size, Image.Resampling.LANCZOS))
 
-    print("Анализ аудио...")
-    amplitudes = []
-    step = 1.0 / fps
+def probe_audio(audio_path):
+    """
+    Кодек первой аудиодорожки и длительность файла в секундах по выводу ffmpeg
+    (None вместо значения, которое не удалось определить)
+    """
+    result = subprocess.run([get_ffmpeg_binary(), '-hide_banner', '-i', audio_path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    output = result.stderr.decode(errors='replace')
+    codec = re.search(r"Stream #\S+.*?: Audio: (\w+)", output)
+    duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", output)
+    seconds = None
+    if duration:
+        seconds = int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+    return (codec.group(1) if codec else None), seconds
+
+def decode_mono_chunks(audio_path, sample_rate, chunk_samples):
+    """
+    Декодирует файл через ffmpeg в моно float32 с частотой sample_rate и отдает его
+    блоками по chunk_samples отсчетов (последний блок короче). Весь трек в памяти не хранится
+    """
+    process = subprocess.Popen([
+        get_ffmpeg_binary(), '-loglevel', 'error', '-i', audio_path, '-vn',
+        # Сведение в моно - среднее каналов, ресемплинг soxr: как librosa.to_mono и res_type='soxr_hq'
+        '-af', 'aresample=resampler=soxr:rematrix_maxval=1', '-ac', '1', '-ar', str(sample_rate),
+        '-f', 'f32le', 'pipe:1'
+    ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        chunk_bytes = chunk_samples * 4
+        while True:
+            data = process.stdout.read(chunk_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.float32)
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read().decode(errors='replace')
+        process.stderr.close()
+        if process.wait() != 0:
+            raise IOError(f"ffmpeg не смог декодировать {audio_path}: {stderr.strip()}")
+
+class NpyRowWriter:
+    """
+    Пишет массив в .npy построчно, когда число строк заранее неизвестно: заголовок .npy
+    оставляет место под любую длину первой оси, поэтому при закрытии он перезаписывается на месте.
+    Файл появляется под итоговым именем только после close()
+    """
 
-    for i in range(int(duration * fps)):
-        t = i * step
+    def __init__(self, path, row_shape, dtype):
+        self.path = path
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.rows = 0
+        fd, self.temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                              dir=os.path.dirname(path) or '.')
+        self.file = os.fdopen(fd, 'wb')
+        np.lib.format.write_array_header_1_0(self.file, self._header())
+        self.header_size = self.file.tell()
+
+    def _header(self):
+        return {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                'shape': (self.rows,) + self.row_shape}
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self.file.write(rows.tobytes())
+        self.rows += len(rows)
+
+    def close(self):
+        self.file.seek(0)
+        np.lib.format.write_array_header_1_0(self.file, self._header())
+        if self.file.tell() != self.header_size:
+            raise IOError(f"Заголовок {self.path} изменил размер")
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        self.file.close()
+        with contextlib.suppress(OSError):
+            os.remove(self.temp_path)
+
+def evict_lru_files(directory, max_bytes, suffix, keep=None):
+    """
+    Удаляет самые давно использованные (по времени изменения) файлы с расширением suffix,
+    пока их суммарный размер больше max_bytes. Файл keep не удаляется
+    """
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(suffix) and path != keep:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    if keep is not None and os.path.exists(keep):
+        total += os.path.getsize(keep)
+
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
         try:
-            start_time = max(0, t - 0.005)
-            end_time = min(duration, t + 0.005)
-            if end_time > start_time:
-                volume = audio_clip.subclip(start_time, end_time).max_volume()
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+class PcmCache:
+    """
+    Дисковый кэш декодированного звука: .npy файлы с ключом из хэша содержимого,
+    вида сигнала ('src' - исходные каналы, 'mono' - моно для анализа) и частоты.
+    Файлы открываются через memmap, поэтому параллельные рендеры делят одни страницы памяти.
+    Время изменения файла служит меткой последнего использования: при превышении
+    max_bytes удаляются давно не использованные записи
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=PCM_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = os.path.join(cache_dir, "pcm")
+        self.max_bytes = max_bytes
+
+    def _prefix(self, digest, kind):
+        return f"pcm_v{PCM_CACHE_VERSION}_{digest[:32]}_{kind}_"
+
+    def _path(self, digest, kind, sample_rate):
+        return os.path.join(self.cache_dir, f"{self._prefix(digest, kind)}{sample_rate}.npy")
+
+    def find(self, digest, kind, sample_rate=None):
+        """
+        (массив, частота) из кэша или None. Без sample_rate подходит любая частота
+        """
+        if sample_rate is None:
+            prefix = self._prefix(digest, kind)
+            names = sorted(os.listdir(self.cache_dir)) if os.path.isdir(self.cache_dir) else []
+            names = [name for name in names if name.startswith(prefix) and name.endswith('.npy')]
+            if not names:
+                return None
+            sample_rate = int(names[0][len(prefix):-len('.npy')])
+
+        path = self._path(digest, kind, sample_rate)
+        try:
+            samples = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return samples, sample_rate
+
+    def store(self, digest, kind, sample_rate, samples):
+        """
+        Сохраняет массив, освобождает место и возвращает его memmap
+        """
+        path = self._path(digest, kind, sample_rate)
+        save_npy_atomic(path, np.ascontiguousarray(samples, dtype=np.float32))
+        self.evict(keep=path)
+        return np.load(path, mmap_mode='r')
+
+    def evict(self, keep=None):
+        evict_lru_files(self.cache_dir, self.max_bytes, '.npy', keep)
+
+def resample_ratio(orig_sr, target_sr, max_factor=1000):
+    """
+    Несократимая пара (up, down) с target_sr / orig_sr = up / down или None,
+    если множители больше max_factor (фильтр полифазного ресемплинга стал бы слишком длинным)
+    """
+    divisor = math.gcd(int(orig_sr), int(target_sr))
+    up, down = int(target_sr) // divisor, int(orig_sr) // divisor
+    if max(up, down) > max_factor:
+        return None
+    return up, down
+
+def resample_audio_poly(audio, up, down):
+    """
+    Меняет частоту сигнала в рациональное число раз up / down: полифазный FIR-фильтр против
+    наложения спектров за один проход без промежуточной повышенной частоты
+    (44.1 кГц -> 24 кГц: up=80, down=147; 48 кГц -> 24 кГц: прореживание в 2 раза)
+    """
+    if up == down:
+        return audio
+    return resample_poly(np.asarray(audio, dtype=np.float32), up, down).astype(np.float32)
+
+class AudioSource:
+    """
+    Аудио трека, декодированное один раз. Из этого буфера берутся данные для анализа
+    (моно с нужной частотой) и звук для итогового видео. Совместимая с MP4 дорожка
+    копируется в видео без перекодирования, остальные кодируются из уже декодированного PCM.
+    С кэшем PCM повторный рендер того же трека не декодирует файл вовсе.
+
+    Треки не короче STREAMING_MIN_DURATION (streaming=True) целиком не декодируются:
+    анализ читает их блоками (decode_mono_chunks), а звук видео ffmpeg берет из файла сам
+    """
+
+    def __init__(self, audio_path, cache=None, streaming=None):
+        self.path = audio_path
+        self.cache = cache
+        self.digest = file_digest(audio_path)
+        self.codec, self.duration = probe_audio(audio_path)
+        if streaming is None:
+            streaming = (STREAMING_MIN_DURATION is not None and self.duration is not None
+                         and self.duration >= STREAMING_MIN_DURATION)
+        self.streaming = streaming
+        self._samples = None
+        self._sample_rate = None
+        self._mono = {}
+
+    def _load(self):
+        if self._samples is not None:
+            return
+        if self.cache is not None:
+            cached = self.cache.find(self.digest, 'src')
+            if cached is not None:
+                self._samples, self._sample_rate = cached
+                return
+
+        # Та же последовательность, что и в librosa.load: декодирование, сведение в моно, ресемплинг
+        samples, self._sample_rate = librosa.load(self.path, sr=None, mono=False)
+        if self.cache is not None:
+            samples = self.cache.store(self.digest, 'src', self._sample_rate, samples)
+        self._samples = samples
+
+    @property
+    def samples(self):
+        self._load()
+        return self._samples
+
+    @property
+    def sample_rate(self):
+        self._load()
+        return self._sample_rate
+
+    @property
+    def channels(self):
+        return 1 if self.samples.ndim == 1 else self.samples.shape[0]
+
+    @property
+    def can_copy(self):
+        return self.codec in AUDIO_COPY_CODECS
+
+    def mono(self, sample_rate=ANALYSIS_SAMPLE_RATE):
+        """
+        Моно сигнал для анализа (результат кэшируется для каждой частоты). Если частоты
+        соотносятся как небольшие целые числа (44.1 и 48 кГц к 24 кГц), используется
+        полифазный ресемплинг, иначе soxr
+        """
+        if sample_rate in self._mono:
+            return self._mono[sample_rate]
+
+        cached = self.cache.find(self.digest, 'mono', sample_rate) if self.cache is not None else None
+        if cached is not None:
+            audio = cached[0]
+        else:
+            audio = librosa.to_mono(np.asarray(self.samples))
+            ratio = resample_ratio(self.sample_rate, sample_rate)
+            if ratio is not None:
+                audio = resample_audio_poly(audio, *ratio)
             else:
-                volume = 0
-            amplitudes.append(min(volume, 1.0))
-        except:
-            amplitudes.append(0)
+                audio = librosa.resample(audio, orig_sr=self.sample_rate, target_sr=sample_rate, res_type='soxr_hq')
+            if self.cache is not None:
+                audio = self.cache.store(self.digest, 'mono', sample_rate, audio)
+
+        self._mono[sample_rate] = audio
+        return audio
+
+    def ffmpeg_input(self, input_index, audio_codec=AUDIO_CODEC, audio_bitrate=AUDIO_BITRATE):
+        """
+        Аргументы ffmpeg для звука как входа номер input_index: (входные, выходные, канал PCM или None).
+        Канал PCM нужно передать процессу через pass_fds и заполнить через feed_pipe.
+        audio_bitrate=None оставляет битрейт кодека по умолчанию
+        """
+        output_args = ['-map', f'{input_index}:a:0']
+        if self.can_copy:
+            return ['-i', self.path], output_args + ['-c:a', 'copy'], None
+        codec_args = ['-c:a', audio_codec] + (['-b:a', audio_bitrate] if audio_bitrate else [])
+        if self.streaming:
+            # ffmpeg декодирует файл сам: PCM длинного трека не проходит через память процесса
+            return ['-i', self.path], output_args + codec_args, None
+
+        read_fd, write_fd = os.pipe()
+        input_args = ['-f', 'f32le', '-ar', str(self.sample_rate), '-ac', str(self.channels),
+                      '-i', f'pipe:{read_fd}']
+        return input_args, output_args + codec_args, (read_fd, write_fd)
+
+    def feed_pipe(self, pipe, chunk_frames=1 << 16):
+        """
+        Пишет PCM (float32, каналы через один) в канал из ffmpeg_input в отдельном потоке
+        """
+        read_fd, write_fd = pipe
+        os.close(read_fd)
+        samples = self.samples.reshape(self.channels, -1)
+
+        def write_loop():
+            try:
+                with open(write_fd, 'wb') as f:
+                    for start in range(0, samples.shape[1], chunk_frames):
+                        f.write(np.ascontiguousarray(samples[:, start:start + chunk_frames].T).tobytes())
+            except OSError:
+                # ffmpeg закончил читать раньше (-shortest)
+                pass
+
+        thread = threading.Thread(target=write_loop, daemon=True)
+        thread.start()
+        return thread
+
+def analysis_fingerprint(fps, width=VISUALIZATION_WIDTH, streaming=False):
+    """
+    Отпечаток параметров анализа: меняется при изменении констант анализа в settings.py.
+    Потоковый анализ декодирует звук через ffmpeg, поэтому его признаки хранятся отдельно
+    """
+    params = (FEATURES_VERSION, ANALYSIS_SAMPLE_RATE, AUDIO_SAMPLE_RATE, fps, width, WAVEFORM_WINDOW,
+              AMPLITUDE_WINDOW, AMPLITUDE_MODE, SMOOTHING_WINDOW_SIZE, SMOOTHING_ALPHA, SPECTRUM_WINDOW,
+              SPECTRUM_MIN_FFT, SPECTRUM_SMOOTHING_SIGMA)
+    if streaming:
+        params += ('streaming',)
+    return hashlib.sha256(repr(params).encode()).hexdigest()
+
+def compute_track_features(audio_mono, sr, fps, width=VISUALIZATION_WIDTH):
+    """
+    Анализ трека с привязкой к кадрам: сглаженная огибающая амплитуды,
+    нормализованный спектр панели и пики столбцов волны для каждого кадра
+    """
+    n_frames = int(len(audio_mono) / sr * fps)
 
+    print("Анализ аудио...")
+    amplitudes = compute_amplitude_envelope(audio_mono, sr, fps, n_frames)
     amplitudes = smooth_amplitudes(amplitudes)
     amplitudes = apply_exponential_smoothing(amplitudes)
 
+    print("Расчет спектра...")
+    spectrum = compute_spectrum_frames(audio_mono, sr, fps, len(amplitudes), width)
+
+    # Волна у краев трека короче ширины панели: храним длину каждой строки
+    waveform = np.zeros((len(amplitudes), width), dtype=np.float32)
+    waveform_lengths = np.zeros(len(amplitudes), dtype=np.int32)
+    for i, t in enumerate(frame_times(len(amplitudes), fps)):
+        window = waveform_peaks(audio_mono, int(t * sr), sr, width)
+        waveform[i, :len(window)] = window
+        waveform_lengths[i] = len(window)
+
+    return {
+        'amplitudes': amplitudes,
+        'spectrum': spectrum,
+        'waveform': waveform,
+        'waveform_lengths': waveform_lengths,
+    }
+
+def compute_track_features_streaming(audio_path, features_dir, sr, fps, width=VISUALIZATION_WIDTH,
+                                     chunk_seconds=STREAMING_CHUNK_SECONDS):
+    """
+    Потоковый анализ длинного трека: звук декодируется блоками по chunk_seconds, и кадр
+    считается, как только в буфере есть все его окна (спектр, волна, амплитуда). В памяти
+    только блок с перекрытием, строки спектра и волны сразу дописываются в .npy в features_dir
+    """
+    reach = max(int(SPECTRUM_WINDOW * sr) // 2, int(WAVEFORM_WINDOW * sr) // 2,
+                max(1, int(AMPLITUDE_WINDOW * sr / 2)) + 1)
+    chunk_samples = max(1, int(chunk_seconds * sr))
+
+    os.makedirs(features_dir, exist_ok=True)
+    spectrum_writer = NpyRowWriter(os.path.join(features_dir, "spectrum.npy"), (width,), np.float32)
+    waveform_writer = NpyRowWriter(os.path.join(features_dir, "waveform.npy"), (width,), np.float32)
+    envelope = []
+    waveform_lengths = []
+
+    buffer = np.zeros(0, dtype=np.float32)
+    buffer_start = 0
+    next_frame = 0
+
+    def analyze(last_frame):
+        # Кадры [next_frame, last_frame) целиком помещаются в буфер
+        centers = frame_centers(next_frame, last_frame, fps, sr) - buffer_start
+        envelope.append(compute_amplitude_envelope(buffer, sr, fps, len(centers), centers=centers))
+        spectrum_writer.append(compute_spectrum_frames(buffer, sr, fps, len(centers), width, centers=centers))
+
+        rows = np.zeros((len(centers), width), dtype=np.float32)
+        for i, center in enumerate(centers):
+            window = waveform_peaks(buffer, int(center), sr, width)
+            rows[i, :len(window)] = window
+            waveform_lengths.append(len(window))
+        waveform_writer.append(rows)
+
+    print("Потоковый анализ аудио...")
+    try:
+        for chunk in decode_mono_chunks(audio_path, sr, chunk_samples):
+            buffer = np.concatenate((buffer, chunk))
+            buffer_end = buffer_start + len(buffer)
+
+            candidates = frame_centers(next_frame, int(buffer_end / sr * fps) + 1, fps, sr)
+            last_frame = next_frame + int(np.count_nonzero(candidates + reach <= buffer_end))
+            if last_frame > next_frame:
+                analyze(last_frame)
+                next_frame = last_frame
+
+            # Отбрасываем начало буфера, которое уже не попадет ни в одно окно
+            keep_from = int(frame_centers(next_frame, next_frame + 1, fps, sr)[0]) - reach
+            if keep_from > buffer_start:
+                buffer = buffer[keep_from - buffer_start:].copy()
+                buffer_start = keep_from
+
+        n_frames = int((buffer_start + len(buffer)) / sr * fps)
+        if n_frames > next_frame:
+            analyze(n_frames)
+    except BaseException:
+        spectrum_writer.abort()
+        waveform_writer.abort()
+        raise
+
+    spectrum_writer.close()
+    waveform_writer.close()
+    amplitudes = np.concatenate(envelope) if envelope else np.zeros(0, dtype=np.float32)
+    amplitudes = apply_exponential_smoothing(smooth_amplitudes(amplitudes))
+    np.save(os.path.join(features_dir, "amplitudes.npy"), amplitudes)
+    np.save(os.path.join(features_dir, "waveform_lengths.npy"), np.array(waveform_lengths, dtype=np.int32))
+    np.save(os.path.join(features_dir, "n_samples.npy"), np.array(buffer_start + len(buffer), dtype=np.int64))
+
+def load_streaming_track_features(audio, fps, width=VISUALIZATION_WIDTH, cache_dir=CACHE_DIR):
+    """
+    Признаки длинного трека: каталог .npy, открываемых через memmap. Каталог появляется
+    под итоговым именем только после завершения анализа
+    """
+    fingerprint = analysis_fingerprint(fps, width, streaming=True)
+    features_dir = os.path.join(cache_dir, "features", f"features_{audio.digest[:32]}_{fingerprint[:16]}")
+
+    if not os.path.isdir(features_dir):
+        os.makedirs(os.path.dirname(features_dir), exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix=os.path.basename(features_dir) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(features_dir))
+        try:
+            compute_track_features_streaming(audio.path, temp_dir, ANALYSIS_SAMPLE_RATE, fps, width)
+            os.replace(temp_dir, features_dir)
+        except OSError:
+            if not os.path.isdir(features_dir):
+                raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    return {name[:-len('.npy')]: np.load(os.path.join(features_dir, name), mmap_mode='r')
+            for name in os.listdir(features_dir) if name.endswith('.npy')}
+
+def load_track_features(audio, fps, width=VISUALIZATION_WIDTH, cache_dir=CACHE_DIR):
+    """
+    Признаки трека из хранилища (ключ - хэш аудио и отпечаток параметров анализа);
+    при отсутствии считает их и сохраняет в .npz рядом с остальным кэшем
+    """
+    if audio.streaming:
+        return load_streaming_track_features(audio, fps, width, cache_dir)
+
+    fingerprint = analysis_fingerprint(fps, width)
+    features_path = os.path.join(cache_dir, "features", f"features_{audio.digest[:32]}_{fingerprint[:16]}.npz")
+
+    try:
+        with np.load(features_path) as data:
+            if str(data['fingerprint']) == fingerprint:
+                return {name: data[name] for name in data.files if name != 'fingerprint'}
+    except (OSError, KeyError, ValueError):
+        pass
+
+    features = compute_track_features(audio.mono(ANALYSIS_SAMPLE_RATE), ANALYSIS_SAMPLE_RATE, fps, width)
+    with atomic_file(features_path) as f:
+        np.savez(f, fingerprint=np.array(fingerprint), **features)
+    return features
+
+def prepare_track_features(audio_path, profiles=(RENDER_PROFILE, PREVIEW_RENDER_PROFILE)):
+    """
+    Декодирует трек и готовит его признаки для профилей рендера заранее
+    (например, сразу после загрузки в бота)
+    """
+    audio = AudioSource(audio_path, PcmCache() if PCM_CACHE_MAX_MB > 0 else None)
+    for name in dict.fromkeys(profiles):
+        profile = get_render_profile(name)
+        load_track_features(audio, profile.fps, profile.vis_width)
+
+def stage_fingerprint(stage, inputs):
+    """
+    Отпечаток этапа рендера: хэш имени этапа, версии и всех его входов
+    (входы - строки, числа и отпечатки предыдущих этапов)
+    """
+    return hashlib.sha256(repr((stage, STAGES_VERSION, inputs)).encode()).hexdigest()
+
+def optional_file_digest(path):
+    return file_digest(path) if os.path.exists(path) else None
+
+class StageCache:
+    """
+    Кэш промежуточных этапов рендера: результат этапа (набор массивов) хранится
+    в .npz с ключом из отпечатка его входов. При пересоздании видео пересчитываются
+    только этапы, входы которых изменились
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=STAGE_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = os.path.join(cache_dir, "stages")
+        self.max_bytes = max_bytes
+        self.fingerprints = OrderedDict()
+        self.report = OrderedDict()
+
+    def get(self, stage, inputs, build):
+        """
+        Результат этапа: из кэша, если отпечаток входов совпал, иначе build()
+        """
+        fingerprint = stage_fingerprint(stage, inputs)
+        self.fingerprints[stage] = fingerprint
+        path = os.path.join(self.cache_dir, f"{stage}_{fingerprint[:32]}.npz")
+
+        try:
+            with np.load(path) as data:
+                result = {name: data[name] for name in data.files}
+            os.utime(path)
+            self.report[stage] = "из кэша"
+            return result
+        except (OSError, ValueError):
+            pass
+
+        result = build()
+        if self.max_bytes > 0:
+            with atomic_file(path) as f:
+                np.savez(f, **result)
+            evict_lru_files(self.cache_dir, self.max_bytes, '.npz', keep=path)
+        self.report[stage] = "пересчитан"
+        return result
+
+    def mark(self, stage, inputs, status):
+        """
+        Учитывает этап, результат которого хранится вне этого кэша
+        """
+        self.fingerprints[stage] = stage_fingerprint(stage, inputs)
+        self.report[stage] = status
+
+    def print_report(self):
+        print("Этапы: " + ", ".join(f"{stage} - {status}" for stage, status in self.report.items()))
+
+def build_cover_stage(image_path, size=1080):
     img = Image.open(image_path).convert('RGB')
-    img = add_white_square_background(img, 1080)
+    img = add_white_square_background(img, size)
+    return {'luminance': np.asarray(luminance_image(img))}
+
+def build_text_stage(artist, title, size=(TEXT_BLOCK_WIDTH, TEXT_LINE_HEIGHT)):
+    artist_block, title_block = create_text_blocks(artist, title, size)
+    return {'artist': np.asarray(luminance_image(artist_block)),
+            'title': np.asarray(luminance_image(title_block))}
+
+def build_visualization_stage(features, width=VISUALIZATION_WIDTH, waveform_height=VISUALIZATION_HEIGHT_WAVEFORM,
+                              spectrum_height=VISUALIZATION_HEIGHT_SPECTRUM):
+    """
+    Геометрия панелей для каждого кадра: полувысоты столбцов волны и высоты столбцов спектра
+    """
+    waveform = features['waveform']
+    lengths = features['waveform_lengths']
+    offsets = np.zeros(waveform.shape, dtype=np.int16)
+    for i in range(len(waveform)):
+        offsets[i, :lengths[i]] = waveform_offsets(waveform[i, :lengths[i]], waveform_height)
+
+    spectrum_heights = np.array([spectrum_bar_heights(row, width, spectrum_height) for row in features['spectrum']],
+                                dtype=np.int16).reshape(len(features['spectrum']), width)
+    return {'waveform_offsets': offsets, 'waveform_lengths': lengths, 'spectrum_heights': spectrum_heights}
+
+def build_overlay_stage(n_frames, fps, bpm):
+    # Эффект выплывания (начинается после статичной обложки): непрозрачность для каждого кадра
+    return {'fade_alphas': np.array([fade_in_alpha(calculate_fade_in_progress(t - 0.2, bpm))
+                                     for t in frame_times(n_frames, fps)], dtype=np.uint8)}
+
+def render_effect_params():
+    """
+    Настройки эффектов и компоновки, от которых зависит каждый кадр
+    """
+    return (THRESHOLD_BASE, THRESHOLD_RANGE, CONTRAST_BASE, CONTRAST_AMPLITUDE_MULTIPLIER,
+            MULTIPLIER_MAIN_IMAGE, MULTIPLIER_VISUALIZATIONS, MULTIPLIER_TEXT, AMPLITUDE_QUANTIZATION_STEP)
 
-    # Загружаем фиксированный GIF
-    gif_frames = load_gif_frames()
-    print(f"Загружено {len(gif_frames)} кадров GIF из {GIF_FILE}")
+def is_encode_current(video_path, fingerprint):
+    """
+    Видео уже закодировано из тех же входов (отпечаток сохранен рядом с файлом)
+    """
+    try:
+        with open(f"{video_path}.stage") as f:
+            return f.read().strip() == fingerprint and os.path.exists(video_path)
+    except OSError:
+        return False
 
-    def make_frame(t):
-        frame = Image.new('RGB', (1920, 1080), (255, 255, 255))
+def mark_encoded(video_path, fingerprint):
+    with open(f"{video_path}.stage", 'w') as f:
+        f.write(fingerprint)
 
-        # Если это первые 0.2 секунды - показываем статичную обложку
+def forget_encode(video_path):
+    if os.path.exists(f"{video_path}.stage"):
+        os.remove(f"{video_path}.stage")
+
+class FrameRenderer:
+    """
+    Состояние рендера одного трека: результаты анализа аудио, подготовленные слои,
+    кэш слоев и компоновщик. make_frame(t) возвращает кадр для момента t
+    """
+
+    def __init__(self, audio, features, image_path, artist, title, bpm=BPM,
+                 beats_per_loop=BEATS_PER_LOOP, profile=None, stages=None, cache_dir=CACHE_DIR):
+        self.profile = profile if profile is not None else get_render_profile()
+        self.sr = ANALYSIS_SAMPLE_RATE
+        self.streaming = audio.streaming
+        if self.streaming:
+            # Потоковый режим: звук в память не загружается, все берется из признаков трека
+            self.audio_mono = None
+            self.duration = int(features['n_samples']) / self.sr
+        else:
+            self.audio_mono = audio.mono(ANALYSIS_SAMPLE_RATE)
+            self.duration = len(self.audio_mono) / self.sr
+        self.fps = self.profile.fps
+        self.bpm = bpm
+        self.stages = stages if stages is not None else StageCache(cache_dir)
+        fps = self.fps
+
+        # Размеры слоев профиля
+        self.main_size = self.profile.main_size
+        self.vis_width = self.profile.vis_width
+        self.waveform_height = self.profile.waveform_height
+        self.spectrum_height = self.profile.spectrum_height
+        self.text_size = self.profile.text_size
+
+        # Результаты анализа из хранилища признаков трека
+        self.stages.mark('analysis', (audio.digest, analysis_fingerprint(fps, self.vis_width, self.streaming)),
+                         "хранилище признаков")
+        analysis_key = self.stages.fingerprints['analysis']
+        self.amplitudes = features['amplitudes']
+        self.waveform_lengths = features['waveform_lengths']
+        self.waveform_rows = features['waveform']
+        self.spectrum_rows = features['spectrum']
+
+        # Яркость статичных элементов считаем один раз на весь рендер
+        cover = self.stages.get('cover', (file_digest(image_path), self.main_size),
+                                lambda: build_cover_stage(image_path, self.main_size))
+        self.cover_luminance = cover['luminance']
+
+        # Создаем отдельные блоки текста
+        text_inputs = (artist, title, optional_file_digest(FONT_FILE), self.text_size)
+        text = self.stages.get('text', text_inputs, lambda: build_text_stage(artist, title, self.text_size))
+        self.artist_luminance = text['artist']
+        self.title_luminance = text['title']
+
+        visualization_inputs = (analysis_key, self.vis_width, self.waveform_height, self.spectrum_height)
+        self._geometry_index = None
+        self._geometry = None
+        if self.streaming:
+            # Геометрия всех кадров длинного трека не держится в памяти: считается для каждого кадра
+            self.stages.mark('visualization', visualization_inputs, "по кадрам")
+            self.waveform_frame_offsets = None
+            self.spectrum_frame_heights = None
+        else:
+            visualization = self.stages.get('visualization', visualization_inputs,
+                                            lambda: build_visualization_stage(features, self.vis_width,
+                                                                              self.waveform_height,
+                                                                              self.spectrum_height))
+            self.waveform_frame_offsets = visualization['waveform_offsets']
+            self.spectrum_frame_heights = visualization['spectrum_heights']
+
+        # Загружаем фиксированный GIF
+        self.gif_atlas = load_gif_atlas(self.profile.gif_width, cache_dir=cache_dir)
+        print(f"Загружено {len(self.gif_atlas)} кадров GIF из {GIF_FILE}")
+        self.gif_loop_duration = calculate_gif_timing(bpm, beats_per_loop)
+
+        overlay_inputs = (optional_file_digest(GIF_FILE), self.profile.gif_width, len(self.amplitudes), fps, bpm,
+                          beats_per_loop)
+        overlay = self.stages.get('overlay', overlay_inputs,
+                                  lambda: build_overlay_stage(len(self.amplitudes), fps, bpm))
+        self.fade_alphas = overlay['fade_alphas']
+
+        # Готовые слои (масштаб + порог) повторно используются между кадрами с близкой амплитудой
+        self.layer_cache = LayerCache()
+        self._source_levels = {}
+        self.compositor, self.frame_pix_fmt = create_compositor(self.profile.width, self.profile.height)
+
+        # Сигнатура состояния последнего собранного кадра
+        self._last_signature = None
+        self.frame_repeated = False
+        self.repeated_frames = 0
+
+    @property
+    def total_frames(self):
+        """
+        Число кадров видео (столько же, сколько перебирает moviepy)
+        """
+        return len(np.arange(0, self.duration, 1.0 / self.fps))
+
+    def frame_time(self, frame_index):
+        return frame_index * (1.0 / self.fps)
+
+    def reset_compositor(self):
+        """
+        Новый компоновщик с чистым буфером (например, в отдельном процессе рендера)
+        """
+        self.compositor, self.frame_pix_fmt = create_compositor(self.compositor.width, self.compositor.height)
+        self._last_signature = None
+
+    def cached_layer(self, layer, source, amplitude, size):
+        """
+        Готовый слой и ключ его содержимого для компоновщика
+        """
+        if (source.shape[1], source.shape[0]) == size:
+            # Без масштабирования результат порога зависит только от того,
+            # сколько уровней яркости источника становятся черными
+            if layer not in self._source_levels:
+                self._source_levels[layer] = luminance_levels(source)
+            variant = ('levels', threshold_class(self._source_levels[layer], amplitude))
+        else:
+            variant = amplitude
+
+        def build():
+            return apply_threshold(resize_plane(source, size), amplitude)
+
+        return self.layer_cache.get(layer, variant, size, build), (layer, variant, size)
+
+    def panel_geometry(self, frame_index):
+        """
+        Полувысоты столбцов волны и высоты столбцов спектра кадра при базовом размере панелей
+        """
+        if self.waveform_frame_offsets is not None:
+            return self.waveform_frame_offsets[frame_index], self.spectrum_frame_heights[frame_index]
+
+        if self._geometry_index != frame_index:
+            length = self.waveform_lengths[frame_index]
+            offsets = np.zeros(self.vis_width, dtype=np.int16)
+            offsets[:length] = waveform_offsets(self.waveform_rows[frame_index, :length], self.waveform_height)
+            heights = spectrum_bar_heights(self.spectrum_rows[frame_index], self.vis_width,
+                                           self.spectrum_height).astype(np.int16)
+            self._geometry_index = frame_index
+            self._geometry = (offsets, heights)
+        return self._geometry
+
+    def gif_frame_at(self, t):
+        cycle_position = (t % self.gif_loop_duration) / self.gif_loop_duration
+        return int(cycle_position * len(self.gif_atlas)) % len(self.gif_atlas)
+
+    def frame_signature(self, t, frame_index, amplitude, fade_alpha):
+        """
+        Дешевая сигнатура всего, от чего зависит кадр: квантованная амплитуда, непрозрачность
+        выплывания, кадр GIF и геометрия панелей. None - кадр нельзя сравнить (панели не из кэша)
+        """
         if t < 0.2:
-            processed_img = apply_ultra_hard_threshold_effect(img, 0)
-            img_width, img_height = processed_img.size
-            x = (1920 - img_width) // 2
-            y = (1080 - img_height) // 2
-            frame.paste(processed_img, (x, y))
-            return np.array(frame)
-
-        frame_index = int(t * fps)
-        if frame_index < len(amplitudes):
-            amplitude = amplitudes[frame_index]
+            return ('static',)
+        if frame_index >= len(self.amplitudes):
+            return None
+        gif_frame_index = self.gif_frame_at(t) if len(self.gif_atlas) else None
+        offsets, heights = self.panel_geometry(frame_index)
+        return (amplitude, fade_alpha, gif_frame_index,
+                self.waveform_lengths[frame_index], offsets.tobytes(), heights.tobytes())
+
+    def make_frame(self, t, acquire_buffer=None):
+        frame_index = frame_index_at(t, self.fps)
+        if frame_index < len(self.amplitudes):
+            amplitude = self.layer_cache.quantize(self.amplitudes[frame_index])
         else:
-            amplitude = 0
+            amplitude = 0.0
 
-        # Вычисляем прогресс выплывания (начинаем после статичной обложки)
-        fade_progress = calculate_fade_in_progress(t - 0.2, bpm)
+        # Непрозрачность выплывающих элементов рассчитана заранее для каждого кадра
+        fade_alpha = int(self.fade_alphas[frame_index]) if frame_index < len(self.fade_alphas) else 255
 
-        # Группа 1: Основное изображение (всегда видно)
-        main_size, main_multiplier = apply_group_shake_effect(1080, amplitude, "main_image")
-        shaken_img = img.resize((main_size, main_size), Image.Resampling.LANCZOS)
-        processed_img = apply_ultra_hard_threshold_effect(shaken_img, amplitude)
+        # Тот же набор входов, что и у предыдущего кадра: буфер компоновщика уже содержит нужный кадр
+        signature = self.frame_signature(t, frame_index, amplitude, fade_alpha)
+        self.frame_repeated = signature is not None and signature == self._last_signature
+        self._last_signature = signature
+        if self.frame_repeated:
+            self.repeated_frames += 1
+            return self.compositor.frame
 
-        img_width, img_height = processed_img.size
-        x = (1920 - img_width) // 2
-        y = (1080 - img_height) // 2
-        frame.paste(processed_img, (x, y))
-
-        # Группа 2: Визуализации с эффектом выплывания
-        vis_size_w, vis_multiplier = apply_group_shake_effect(VISUALIZATION_WIDTH, amplitude, "visualizations")
-        vis_size_h_wave = int(VISUALIZATION_HEIGHT_WAVEFORM * vis_multiplier)
-        vis_size_h_spec = int(VISUALIZATION_HEIGHT_SPECTRUM * vis_multiplier)
+        # Если это первые 0.2 секунды - показываем статичную обложку
+        if t < 0.2:
+            static_cover, cover_key = self.cached_layer('main', self.cover_luminance, 0.0,
+                                                        (self.main_size, self.main_size))
+            layout = compute_layout(self.profile, self.main_size)
+            return self.compositor.compose([('main', cover_key, static_cover, *layout['main'], 255)],
+                                           acquire_buffer() if acquire_buffer else None)
 
-        waveform_img = create_waveform_visualization(audio_mono, t, sr, vis_size_w, vis_size_h_wave)
-        spectrum_img = create_spectrum_visualization(audio_mono, t, sr, vis_size_w, vis_size_h_spec)
+        # Группа 1: Основное изображение (всегда видно)
+        main_size, main_multiplier = apply_group_shake_effect(self.main_size, amplitude, "main_image")
+        processed_img, main_key = self.cached_layer('main', self.cover_luminance, amplitude,
+                                                    (main_size, main_size))
 
-        waveform_processed = apply_ultra_hard_threshold_effect(waveform_img, amplitude)
-        spectrum_processed = apply_ultra_hard_threshold_effect(spectrum_img, amplitude)
+        # Группа 2: Визуализации с эффектом выплывания
+        vis_size_w, vis_multiplier = apply_group_shake_effect(self.vis_width, amplitude, "visualizations")
+        vis_size_h_wave = int(self.waveform_height * vis_multiplier)
+        vis_size_h_spec = int(self.spectrum_height * vis_multiplier)
+
+        # При базовом размере панелей геометрия столбцов уже рассчитана на этапе visualization
+        base_panels = (vis_size_w == self.vis_width and vis_size_h_wave == self.waveform_height
+                       and vis_size_h_spec == self.spectrum_height and frame_index < len(self.amplitudes))
+        if base_panels:
+            offsets, heights = self.panel_geometry(frame_index)
+            waveform_plane = rasterize_waveform_offsets(offsets[:self.waveform_lengths[frame_index]],
+                                                        vis_size_w, vis_size_h_wave)
+            spectrum_plane = rasterize_bars(heights, vis_size_h_spec)
+        elif self.streaming:
+            # Звука в памяти нет: строки признаков растягиваются до размера панелей
+            if frame_index < len(self.amplitudes):
+                waveform_data = resample_columns(self.waveform_rows[frame_index, :self.waveform_lengths[frame_index]],
+                                                 vis_size_w)
+                fft_display = resample_columns(self.spectrum_rows[frame_index], vis_size_w)
+            else:
+                waveform_data, fft_display = np.zeros(0, dtype=np.float32), None
+            waveform_plane = rasterize_waveform(waveform_data, vis_size_w, vis_size_h_wave)
+            spectrum_plane = rasterize_spectrum(fft_display, vis_size_w, vis_size_h_spec)
+        else:
+            waveform_data = waveform_peaks(self.audio_mono, int(t * self.sr), self.sr, vis_size_w)
+            waveform_plane = rasterize_waveform(waveform_data, vis_size_w, vis_size_h_wave)
+            fft_display = spectrum_display_at(self.audio_mono, t, self.sr, vis_size_w)
+            spectrum_plane = rasterize_spectrum(fft_display, vis_size_w, vis_size_h_spec)
+        waveform_plane[:, waveform_playhead_columns(vis_size_w)] = PLAYHEAD_LUMINANCE
 
-        # Применяем эффект выплывания к визуализациям
-        waveform_faded = apply_fade_in_effect(waveform_processed, fade_progress)
-        spectrum_faded = apply_fade_in_effect(spectrum_processed, fade_progress)
+        # Применяем эффект порога к визуализациям
+        waveform_processed = apply_threshold(waveform_plane, amplitude, out=waveform_plane)
+        spectrum_processed = apply_threshold(spectrum_plane, amplitude, out=spectrum_plane)
 
         # GIF с эффектом выплывания
-        current_gif_frame = None
+        processed_gif = None
         gif_height = vis_size_h_wave
 
-        if gif_frames:
-            cycle_position = (t % gif_loop_duration) / gif_loop_duration
-            gif_frame_index = int(cycle_position * len(gif_frames)) % len(gif_frames)
-            current_gif_frame = gif_frames[gif_frame_index]
+        if len(self.gif_atlas):
+            gif_frame_index = self.gif_frame_at(t)
+            current_gif_frame = self.gif_atlas[gif_frame_index]
 
-            gif_w, gif_h = current_gif_frame.size
-            new_gif_w = int(gif_w * vis_multiplier)
-            new_gif_h = int(gif_h * vis_multiplier)
-            current_gif_frame = current_gif_frame.resize((new_gif_w, new_gif_h), Image.Resampling.LANCZOS)
-            gif_height = new_gif_h
+            gif_h, gif_w = current_gif_frame.shape
+            gif_size = (int(gif_w * vis_multiplier), int(gif_h * vis_multiplier))
+            processed_gif, gif_key = self.cached_layer(('gif', gif_frame_index), current_gif_frame,
+                                                       amplitude, gif_size)
+            gif_height = gif_size[1]
 
-        # Размещение визуализаций
-        total_height = vis_size_h_spec + 20 + vis_size_h_wave + 20 + gif_height
-        center_screen = 540
-        start_y = center_screen - (total_height // 2)
-        vis_x = 20
+        # Группа 3: Текстовые блоки с эффектом выплывания
+        text_size_w, text_multiplier = apply_group_shake_effect(self.text_size[0], amplitude, "text")
+        text_size = (text_size_w, int(self.text_size[1] * text_multiplier))
+
+        artist_processed, artist_key = self.cached_layer('artist', self.artist_luminance, amplitude, text_size)
+        title_processed, title_key = self.cached_layer('title', self.title_luminance, amplitude, text_size)
+
+        layout = compute_layout(self.profile, main_size, vis_size_w, vis_size_h_spec, vis_size_h_wave, gif_height,
+                                text_size)
+
+        # Слои снизу вверх; волна и спектр меняются каждый кадр (ключ None)
+        layers = [
+            ('main', main_key, processed_img, *layout['main'], 255),
+            ('spectrum', None, spectrum_processed, *layout['spectrum'], fade_alpha),
+            ('waveform', None, waveform_processed, *layout['waveform'], fade_alpha),
+        ]
+        if processed_gif is not None:
+            layers.append(('gif', gif_key, processed_gif, *layout['gif'], fade_alpha))
+        layers.append(('artist', artist_key, artist_processed, *layout['artist'], fade_alpha))
+        layers.append(('title', title_key, title_processed, *layout['title'], fade_alpha))
+
+        # Кадр собирается прямо в буфере кодировщика, если он передан
+        return self.compositor.compose(layers, acquire_buffer() if acquire_buffer else None)
+
+    def print_stats(self):
+        cache_stats = self.layer_cache.stats()
+        print(f"Кэш слоев: {cache_stats['hits']} попаданий, {cache_stats['misses']} промахов "
+              f"({cache_stats['hit_rate']:.0%}), {cache_stats['bytes'] / 1024 / 1024:.1f} МБ")
+        print(f"Перерисовано в среднем {self.compositor.repainted_share:.1%} кадра")
+        print(f"Повторено кадров без сборки: {self.repeated_frames}")
+
+def get_ffmpeg_binary():
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def raw_frame_shape(pix_fmt, width, height):
+    """
+    Форма буфера сырого кадра для ffmpeg: rgb24 - (h, w, 3), gray - (h, w),
+    monob - упакованные биты (h, w / 8)
+    """
+    if pix_fmt == 'rgb24':
+        return height, width, 3
+    if pix_fmt == 'gray':
+        return height, width
+    if pix_fmt == 'monob':
+        return height, width // 8
+    raise ValueError(f"Неподдерживаемый формат кадра: {pix_fmt}")
+
+class FFmpegWriter:
+    """
+    Кодирует кадры, передавая их в ffmpeg через stdin как сырые данные (RGB, 8-битные или 1-битные).
+    Запись в канал идет в отдельном потоке через ограниченную очередь:
+    рендер следующего кадра не ждет кодировщик, пока очередь не заполнена.
+    Звук (если задан audio - AudioSource) копируется из исходного файла или кодируется из PCM
+    """
+
+    def __init__(self, output_path, size, fps, audio=None, codec=VIDEO_CODEC, preset=VIDEO_PRESET,
+                 crf=VIDEO_CRF, threads=VIDEO_THREADS, pix_fmt=VIDEO_PIX_FMT, audio_codec=AUDIO_CODEC,
+                 audio_bitrate=AUDIO_BITRATE, queue_size=ENCODER_QUEUE_SIZE, extra_params=None,
+                 input_pix_fmt='rgb24'):
+        self.width, self.height = size
+        command = [
+            get_ffmpeg_binary(), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', input_pix_fmt, '-s', f"{self.width}x{self.height}",
+            '-r', str(fps), '-i', '-',
+        ]
+        audio_pipe = None
+        if audio is not None:
+            input_args, output_args, audio_pipe = audio.ffmpeg_input(1, audio_codec, audio_bitrate)
+            command += input_args + ['-map', '0:v:0'] + output_args + ['-shortest']
+        command += ['-c:v', codec, '-preset', preset, '-crf', str(crf),
+                    '-threads', str(threads), '-pix_fmt', pix_fmt]
+        command += list(extra_params or [])
+        command.append(output_path)
+
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        pass_fds=(audio_pipe[0],) if audio_pipe else ())
+        if audio_pipe is not None:
+            audio.feed_pipe(audio_pipe)
+
+        # Буферы переиспользуются: в очереди не больше queue_size кадров, еще один буфер
+        # держит последний кадр для повторов и один заполняется. Свободные буферы выдаются
+        # стопкой (последний освободившийся - первым): в нем кадр, отстающий от текущего меньше всего
+        self._free = queue.LifoQueue()
+        frame_shape = raw_frame_shape(input_pix_fmt, self.width, self.height)
+        for _ in range(queue_size + 2):
+            self._free.put(np.empty(frame_shape, dtype=np.uint8))
+        self._pending = queue.Queue(maxsize=queue_size)
+        self._refs = {}
+        self._refs_lock = threading.Lock()
+        self._last = None
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def _write_loop(self):
+        while True:
+            buffer = self._pending.get()
+            if buffer is None:
+                break
+            if self._error is None:
+                try:
+                    self.process.stdin.write(memoryview(buffer).cast('B'))
+                except OSError as e:
+                    self._error = e
+            self._release(buffer)
+
+    def _retain(self, buffer, count=1):
+        with self._refs_lock:
+            self._refs[id(buffer)] = self._refs.get(id(buffer), 0) + count
+
+    def _release(self, buffer):
+        # Буфер возвращается в пул, когда его не ждет ни очередь, ни повтор кадра
+        with self._refs_lock:
+            self._refs[id(buffer)] -= 1
+            if self._refs[id(buffer)] > 0:
+                return
+            del self._refs[id(buffer)]
+        self._free.put(buffer)
+
+    def acquire_buffer(self):
+        """
+        Свободный буфер из пула для следующего кадра: вызывающий заполняет его сам и передает
+        в write_buffer(). В буфере остается кадр, который он держал раньше
+        """
+        if self._error is not None:
+            self.close()
+        return self._free.get()
+
+    def write_buffer(self, buffer):
+        """
+        Ставит в очередь на запись буфер, полученный из acquire_buffer(), без копирования
+        """
+        self._retain(buffer, 2)
+        if self._last is not None:
+            self._release(self._last)
+        self._last = buffer
+        self._pending.put(buffer)
+
+    def write_frame(self, frame):
+        """
+        Ставит кадр в очередь на запись. Кадр копируется в буфер из пула,
+        поэтому вызывающий может сразу переиспользовать свой буфер
+        """
+        buffer = self.acquire_buffer()
+        np.copyto(buffer, frame)
+        self.write_buffer(buffer)
+
+    def repeat_frame(self):
+        """
+        Повторяет предыдущий кадр без копирования (кадр не изменился)
+        """
+        if self._error is not None:
+            self.close()
+        if self._last is None:
+            raise ValueError("Нет кадра для повтора")
+        self._retain(self._last)
+        self._pending.put(self._last)
+
+    def close(self):
+        """
+        Дожидается записи всех кадров и завершения ffmpeg
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._thread.is_alive():
+            self._pending.put(None)
+            self._thread.join()
+        if not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+        stderr = self.process.stderr.read().decode(errors='replace')
+        self.process.stderr.close()
+        returncode = self.process.wait()
+        if returncode != 0 or self._error is not None:
+            raise IOError(f"ffmpeg завершился с ошибкой ({returncode}): {stderr.strip()}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.process.kill()
+            try:
+                self.close()
+            except IOError:
+                pass
 
-        current_y = start_y
-        frame.paste(spectrum_faded, (vis_x, current_y))
+class RenderCancelled(Exception):
+    """
+    Рендер остановлен по запросу (cancel_event)
+    """
 
-        current_y += vis_size_h_spec + 20
-        frame.paste(waveform_faded, (vis_x, current_y))
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise RenderCancelled("Рендер отменен")
 
-        current_y += vis_size_h_wave + 20
-        if gif_frames and current_gif_frame:
-            processed_gif = apply_ultra_hard_threshold_effect(current_gif_frame, amplitude)
-            gif_faded = apply_fade_in_effect(processed_gif, fade_progress)
-            frame.paste(gif_faded, (vis_x, current_y))
+def render_frames(renderer, writer, start_frame, end_frame, preview_writer=None, preview_end=0,
+                  cancel_event=None):
+    """
+    Рендерит кадры [start_frame, end_frame) по общей сетке времени и отдает их кодировщику.
+    Кадры до preview_end дополнительно уходят в preview_writer, который закрывается
+    сразу после последнего кадра превью. Установленный cancel_event прерывает рендер
+    """
+    for frame_index in range(start_frame, end_frame):
+        check_cancelled(cancel_event)
+        # Новый кадр компоновщик собирает прямо в буфере кодировщика
+        frame = renderer.make_frame(renderer.frame_time(frame_index), writer.acquire_buffer)
+        # Кадр с той же сигнатурой, что и предыдущий, кодировщик просто повторяет
+        repeated = renderer.frame_repeated and frame_index > start_frame
+        if repeated:
+            writer.repeat_frame()
+        elif renderer.frame_repeated:
+            # Первый кадр совпал с последним кадром прошлого рендера: он лежит не в буфере этого кодировщика
+            writer.write_buffer(renderer.compositor.export(writer.acquire_buffer()))
+        else:
+            writer.write_buffer(frame)
+        if preview_writer is not None:
+            if repeated:
+                preview_writer.repeat_frame()
+            else:
+                preview_writer.write_buffer(renderer.compositor.export(preview_writer.acquire_buffer()))
+            if frame_index + 1 >= preview_end:
+                preview_writer.close()
+                preview_writer = None
 
-        # Группа 3: Текстовые блоки с эффектом выплывания
-        text_size_w, text_multiplier = apply_group_shake_effect(TEXT_BLOCK_WIDTH, amplitude, "text")
-        text_size_h = int(TEXT_LINE_HEIGHT * text_multiplier)
+    if preview_writer is not None:
+        preview_writer.close()
 
-        # Масштабируем блоки текста
-        scaled_artist = artist_block.resize((text_size_w, text_size_h), Image.Resampling.LANCZOS)
-        scaled_title = title_block.resize((text_size_w, text_size_h), Image.Resampling.LANCZOS)
+def create_preview_writer(preview_path, size, fps, audio, input_pix_fmt='rgb24'):
+    """
+    Кодировщик превью: уменьшенное разрешение и более высокий CRF (для Telegram)
+    """
+    extra_params = []
+    if PREVIEW_WIDTH and PREVIEW_WIDTH < size[0]:
+        extra_params = ['-vf', f"scale={PREVIEW_WIDTH}:-2:flags=area"]
+    return FFmpegWriter(preview_path, size, fps, audio=audio, crf=PREVIEW_CRF,
+                        audio_bitrate=PREVIEW_AUDIO_BITRATE, extra_params=extra_params, input_pix_fmt=input_pix_fmt)
 
-        # Применяем эффект порога
-        artist_processed = apply_ultra_hard_threshold_effect(scaled_artist, amplitude)
-        title_processed = apply_ultra_hard_threshold_effect(scaled_title, amplitude)
+def cut_preview(video_path, preview_path, duration=PREVIEW_DURATION):
+    """
+    Вырезает начало готового видео копированием потоков (без перекодирования).
+    Видео начинается с ключевого кадра, поэтому отрезок с нуля всегда корректен
+    """
+    subprocess.run([
+        get_ffmpeg_binary(), '-y', '-loglevel', 'error',
+        '-i', video_path, '-t', str(duration),
+        '-map', '0', '-c', 'copy', preview_path
+    ], check=True)
 
-        # Применяем эффект выплывания к тексту
-        artist_faded = apply_fade_in_effect(artist_processed, fade_progress)
-        title_faded = apply_fade_in_effect(title_processed, fade_progress)
+# Рендер процесса-воркера: строится при первом сегменте и переиспользуется для следующих
+_segment_renderer = None
+_segment_render_args = None
 
-        # Вычисляем позиции (низ видео = начало координат)
-        artist_center_y_from_bottom = 145 + TEXT_LINE_HEIGHT // 2
-        artist_y = 1080 - artist_center_y_from_bottom - text_size_h // 2
+def render_process_context():
+    """
+    Контекст пула процессов рендера: forkserver, где он есть, иначе spawn.
+    fork не используется: рендер запускается из потоков бота, а дочерний процесс
+    fork наследует блокировки, захваченные другими потоками в момент fork
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
 
-        title_center_y_from_bottom = 935 - TEXT_LINE_HEIGHT // 2
-        title_y = 1080 - title_center_y_from_bottom - text_size_h // 2
+def _load_segment_renderer(audio_path, image_path, artist, title, bpm, beats_per_loop, profile_name, cache_dir):
+    """
+    Строит рендер процесса-воркера из путей и параметров. Признаки трека, звук и этапы
+    рендера берутся из кэшей, заполненных основным процессом
+    """
+    profile = get_render_profile(profile_name)
+    audio = AudioSource(audio_path, PcmCache(cache_dir) if PCM_CACHE_MAX_MB > 0 else None)
+    features = load_track_features(audio, profile.fps, profile.vis_width, cache_dir)
+    return FrameRenderer(audio, features, image_path, artist, title, bpm, beats_per_loop, profile,
+                         StageCache(cache_dir), cache_dir)
 
-        # X позиция справа
-        text_x = 1920 - text_size_w - 20
+def _render_segment(segment):
+    """
+    Рендерит кадры [start_frame, end_frame) в отдельный видеофайл без звука.
+    Каждый сегмент начинается с ключевого кадра и использует закрытые GOP,
+    поэтому сегменты можно склеить копированием потока
+    """
+    global _segment_renderer, _segment_render_args
+    render_args, start_frame, end_frame, segment_path = segment
+    # Рендер строится в самой задаче, а не в инициализаторе пула: ошибка инициализатора
+    # заставляет пул бесконечно перезапускать воркеры, а ошибка задачи доходит до основного процесса
+    if _segment_render_args != render_args:
+        _segment_renderer = _load_segment_renderer(*render_args)
+        _segment_render_args = render_args
+    renderer = _segment_renderer
+    renderer.reset_compositor()
+
+    size = (renderer.compositor.width, renderer.compositor.height)
+    with FFmpegWriter(segment_path, size, renderer.fps, extra_params=['-x264-params', 'open-gop=0'],
+                      input_pix_fmt=renderer.frame_pix_fmt) as writer:
+        render_frames(renderer, writer, start_frame, end_frame)
+    return segment_path
+
+def render_segments_parallel(render_args, total_frames, audio, output_path, workers, cancel_event=None):
+    """
+    Делит таймлайн на workers диапазонов кадров, рендерит их в отдельных процессах
+    и склеивает сегменты без перекодирования, добавляя звук один раз в конце.
+    render_args - аргументы _load_segment_renderer: воркеры получают только пути и параметры
+    и строят свой рендер сами, поэтому одновременные рендеры не мешают друг другу.
+    Установленный cancel_event останавливает воркеры
+    """
+    if total_frames <= 0:
+        raise ValueError("Нет кадров для рендера")
+    bounds = np.linspace(0, total_frames, workers + 1).astype(int)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_path))) as temp_dir:
+        segments = [(render_args, int(start), int(end), os.path.join(temp_dir, f"segment_{i:03d}.mp4"))
+                    for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])) if end > start]
+
+        with render_process_context().Pool(len(segments)) as pool:
+            result = pool.map_async(_render_segment, segments)
+            # Выход из блока с исключением отмены завершает воркеры (Pool.terminate)
+            while not result.ready():
+                result.wait(0.5)
+                check_cancelled(cancel_event)
+            segment_paths = result.get()
+
+        concat_list = os.path.join(temp_dir, "segments.txt")
+        with open(concat_list, 'w') as f:
+            for segment_path in segment_paths:
+                f.write(f"file '{segment_path}'\n")
+
+        input_args, output_args, audio_pipe = audio.ffmpeg_input(1)
+        command = [
+            get_ffmpeg_binary(), '-y', '-loglevel', 'error',
+            '-f', 'concat', '-safe', '0', '-i', concat_list,
+        ] + input_args + ['-map', '0:v:0'] + output_args + ['-c:v', 'copy', '-shortest', output_path]
+
+        process = subprocess.Popen(command, pass_fds=(audio_pipe[0],) if audio_pipe else ())
+        if audio_pipe is not None:
+            audio.feed_pipe(audio_pipe)
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+def create_audio_visualizer(audio_path, image_path, output_path, bpm=BPM, beats_per_loop=BEATS_PER_LOOP,
+                            workers=RENDER_WORKERS, preview_path=None, preview_only=False, cancel_event=None,
+                            profile=None, artist=None, title=None, cache_dir=CACHE_DIR):
+    """
+    Рендерит видео для трека. С preview_path параллельно пишется превью;
+    с preview_only=True рендерится только окно превью (output_path не создается).
+    cancel_event (threading.Event) позволяет прервать рендер из другого потока.
+    profile - имя профиля из RENDER_PROFILES (по умолчанию RENDER_PROFILE,
+    для preview_only - PREVIEW_RENDER_PROFILE). artist и title - текст блоков
+    исполнителя и названия (по умолчанию берутся из метаданных аудиофайла).
+    cache_dir - каталог кэшей звука, признаков трека и этапов рендера
+    """
+    if profile is None:
+        profile = PREVIEW_RENDER_PROFILE if preview_only else RENDER_PROFILE
+    profile = get_render_profile(profile)
+    print(f"Профиль рендера: {profile.name} ({profile.width}x{profile.height}, {profile.fps} к/с)")
 
-        # Размещаем блоки
-        frame.paste(artist_faded, (text_x, artist_y))
-        frame.paste(title_faded, (text_x, title_y))
+    print("Загружаю аудио для визуализаций...")
+    audio = AudioSource(audio_path, PcmCache(cache_dir) if PCM_CACHE_MAX_MB > 0 else None)
 
-        return np.array(frame)
+    if artist is None or title is None:
+        metadata_artist, metadata_title = get_audio_metadata(audio_path)
+        artist = metadata_artist if artist is None else artist
+        title = metadata_title if title is None else title
+    print(f"Исполнитель: {artist}")
+    print(f"Название: {title}")
+    if audio.streaming:
+        print(f"Длительность {audio.duration:.0f} с: потоковый режим, кодек {audio.codec}")
+    else:
+        print(f"Качество аудио: {audio.sample_rate} Гц, {audio.channels} кан., кодек {audio.codec}")
+
+    features = load_track_features(audio, profile.fps, profile.vis_width, cache_dir)
+    stages = StageCache(cache_dir)
+    renderer = FrameRenderer(audio, features, image_path, artist, title, bpm, beats_per_loop, profile, stages,
+                             cache_dir)
+    check_cancelled(cancel_event)
+
+    # Этап encode: результат - сам видеофайл, его отпечаток хранится рядом с ним
+    frame_inputs = (tuple(stages.fingerprints.items()), tuple(profile), COMPOSITOR_MODE, ENCODER_INPUT_PIX_FMT,
+                    render_effect_params())
+    encode_inputs = (frame_inputs, audio.digest, VIDEO_CODEC, VIDEO_PRESET, VIDEO_CRF, VIDEO_PIX_FMT,
+                     AUDIO_CODEC, AUDIO_BITRATE, tuple(AUDIO_COPY_CODECS))
+    main_fingerprint = stage_fingerprint('encode', encode_inputs)
+    preview_fingerprint = stage_fingerprint('encode', (encode_inputs, PREVIEW_DURATION, PREVIEW_WIDTH,
+                                                       PREVIEW_CRF, PREVIEW_AUDIO_BITRATE))
+    need_main = not preview_only and not is_encode_current(output_path, main_fingerprint)
+    need_preview = preview_path is not None and not is_encode_current(preview_path, preview_fingerprint)
+    stages.report['encode'] = "пересчитан" if need_main or need_preview else "из кэша"
+    stages.print_report()
+
+    if not need_main and not need_preview:
+        print("Видео не изменилось, рендер не нужен")
+        return
+
+    if need_main:
+        # Создаем обложку
+        thumbnail_path = output_path.replace('.mp4', '_thumbnail.jpg')
+        create_thumbnail(image_path, thumbnail_path)
+        forget_encode(output_path)
+    if need_preview:
+        forget_encode(preview_path)
+
+    size = (renderer.compositor.width, renderer.compositor.height)
+    preview_end = int(round(PREVIEW_DURATION * renderer.fps))
+
+    if not need_main:
+        print("Создание превью...")
+        with create_preview_writer(preview_path, size, renderer.fps, audio, renderer.frame_pix_fmt) as preview_writer:
+            render_frames(renderer, preview_writer, 0, min(preview_end, renderer.total_frames),
+                          cancel_event=cancel_event)
+        mark_encoded(preview_path, preview_fingerprint)
+        return
+
+    if workers > 1 and renderer.total_frames > 0:
+        print(f"Создание видео в {workers} процессах...")
+        # Абсолютные пути: рабочий каталог процессов forkserver не обязан совпадать с нашим
+        render_args = (os.path.abspath(audio_path), os.path.abspath(image_path), artist, title, bpm, beats_per_loop,
+                       profile.name, os.path.abspath(cache_dir))
+        render_segments_parallel(render_args, renderer.total_frames, audio, output_path, workers, cancel_event)
+        check_cancelled(cancel_event)
+        mark_encoded(output_path, main_fingerprint)
+        if need_preview:
+            cut_preview(output_path, preview_path)
+            mark_encoded(preview_path, preview_fingerprint)
+        return
 
     print("Создание видео...")
-    video_clip = VideoClip(make_frame, duration=duration)
-    video_clip = video_clip.set_fps(fps)
-
-    final_clip = video_clip.set_audio(audio_clip)
+    preview_writer = None
+    if need_preview:
+        # Превью кодируется параллельно с основным видео из тех же кадров
+        preview_writer = create_preview_writer(preview_path, size, renderer.fps, audio, renderer.frame_pix_fmt)
 
-    final_clip.write_videofile(output_path, codec='libx264', audio_codec='aac',
-                              verbose=False, logger=None, temp_audiofile='temp-audio.m4a',
-                              remove_temp=True)
+    with FFmpegWriter(output_path, size, renderer.fps, audio=audio, input_pix_fmt=renderer.frame_pix_fmt) as writer, \
+            (preview_writer or contextlib.nullcontext()):
+        render_frames(renderer, writer, 0, renderer.total_frames, preview_writer, preview_end, cancel_event)
 
-    video_clip.close()
-    final_clip.close()
-    audio_clip.close()
+    mark_encoded(output_path, main_fingerprint)
+    if need_preview:
+        mark_encoded(preview_path, preview_fingerprint)
+    renderer.print_stats()
 
-def apply_ultra_hard_threshold_effect(img, amplitude):
-    img_array = np.array(img)
-    gray = np.dot(img_array[..., :3], [0.2989, 0.5870, 0.1140])
+def luminance_image(img):
+    """
+    Яркость изображения (режим 'L') с теми же весами каналов, что и у эффекта порога.
+    Дробная часть отбрасывается, поэтому при целом пороге результат совпадает с расчетом в float
+    """
+    if img.mode == 'L':
+        return img
+    rgb = np.asarray(img.convert('RGB'), dtype=np.uint32)
+    return Image.fromarray((rgb @ LUMINANCE_WEIGHTS // 10000).astype(np.uint8))
 
+@lru_cache(maxsize=1024)
+def threshold_lut(amplitude):
+    """
+    Таблица из 256 значений: яркость -> черный (0) или белый (255) с учетом контраста и порога
+    для данной амплитуды
+    """
+    levels = np.arange(256, dtype=np.float64)
     threshold_value = THRESHOLD_BASE - amplitude * THRESHOLD_RANGE
-    enhanced_gray = np.clip(gray * (CONTRAST_BASE + amplitude * CONTRAST_AMPLITUDE_MULTIPLIER), 0, 255)
+    enhanced_gray = np.clip(levels * (CONTRAST_BASE + amplitude * CONTRAST_AMPLITUDE_MULTIPLIER), 0, 255)
+
+    lut = np.where(enhanced_gray < threshold_value, 0, 255).astype(np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+def luminance_levels(luminance):
+    """
+    Уровни яркости, встречающиеся в плоскости
+    """
+    return np.flatnonzero(np.bincount(luminance.ravel(), minlength=256))
+
+def threshold_class(levels, amplitude):
+    """
+    Сколько уровней яркости из levels становятся черными при данной амплитуде.
+    Порог монотонен по яркости, поэтому одинаковое число означает одинаковый результат
+    """
+    return int(np.count_nonzero(threshold_lut(float(amplitude))[levels] == 0))
 
-    dark_mask = enhanced_gray < threshold_value
-    result = np.full_like(img_array, 255)
-    result[dark_mask] = [0, 0, 0]
+def apply_threshold(luminance, amplitude, out=None):
+    """
+    Эффект порога для плоскости яркости uint8: возвращает одноканальную черно-белую плоскость
+    """
+    return np.take(threshold_lut(float(amplitude)), luminance, out=out, mode='clip')
+
+class LayerCache:
+    """
+    LRU-кэш готовых слоев (после масштабирования и эффекта порога) с ограничением по памяти.
+    Ключ - (слой, квантованная амплитуда, размер); амплитуда квантуется с шагом quantization_step
+    """
+
+    def __init__(self, max_bytes=LAYER_CACHE_MAX_MB * 1024 * 1024,
+                 quantization_step=AMPLITUDE_QUANTIZATION_STEP):
+        self.max_bytes = max_bytes
+        self.quantization_step = quantization_step
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def quantize(self, amplitude):
+        """
+        Округляет амплитуду до шага квантования (0 - без квантования)
+        """
+        if self.quantization_step <= 0:
+            return float(amplitude)
+        return round(round(amplitude / self.quantization_step) * self.quantization_step, 6)
+
+    def get(self, layer, amplitude, size, build):
+        """
+        Возвращает слой из кэша или строит его функцией build() и запоминает
+        """
+        key = (layer, amplitude, size)
+        plane = self._entries.get(key)
+        if plane is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return plane
+
+        self.misses += 1
+        plane = build()
+        plane.setflags(write=False)
+
+        if plane.nbytes <= self.max_bytes:
+            self._entries[key] = plane
+            self.current_bytes += plane.nbytes
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+        return plane
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'entries': len(self._entries),
+            'bytes': self.current_bytes,
+        }
+
+def paste_plane(canvas, plane, x, y, fade_alpha=255, clip=None):
+    """
+    Вставляет плоскость в кадр по координатам левого верхнего угла, обрезая выходящие за края части
+    (и за прямоугольник clip = (x0, y0, x1, y1), если он задан).
+    fade_alpha < 255 сразу смешивает черно-белую плоскость с белым фоном (эффект выплывания):
+    для значений 0/255 смешивание сводится к max(v, 255 - alpha) и выполняется без промежуточных массивов
+    """
+    plane_height, plane_width = plane.shape[:2]
+    bounds = clip or (0, 0, canvas.shape[1], canvas.shape[0])
+    x0, y0 = max(x, bounds[0]), max(y, bounds[1])
+    x1 = min(x + plane_width, bounds[2])
+    y1 = min(y + plane_height, bounds[3])
+    if x1 <= x0 or y1 <= y0:
+        return
+
+    region = canvas[y0:y1, x0:x1]
+    visible = plane[y0 - y:y1 - y, x0 - x:x1 - x]
+    if fade_alpha >= 255:
+        region[...] = visible
+    else:
+        np.maximum(visible, np.uint8(255 - fade_alpha), out=region)
+
+def _intersect_rects(a, b):
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[2], b[2]), min(a[3], b[3])
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1, y1)
+
+def _subtract_rects(rect, cuts):
+    """
+    Части прямоугольника rect, не покрытые ни одним из cuts
+    """
+    pieces = [rect]
+    for cut in cuts:
+        remaining = []
+        for piece in pieces:
+            inner = _intersect_rects(piece, cut)
+            if inner is None:
+                remaining.append(piece)
+                continue
+            x0, y0, x1, y1 = piece
+            ix0, iy0, ix1, iy1 = inner
+            for part in ((x0, y0, x1, iy0), (x0, iy1, x1, y1), (x0, iy0, ix0, iy1), (ix1, iy0, x1, iy1)):
+                if part[0] < part[2] and part[1] < part[3]:
+                    remaining.append(part)
+        pieces = remaining
+    return pieces
+
+def _merge_rects(rects):
+    """
+    Убирает повторяющиеся прямоугольники и прямоугольники, целиком лежащие внутри других
+    """
+    unique = sorted(set(rects), key=lambda r: (r[2] - r[0]) * (r[3] - r[1]), reverse=True)
+    merged = []
+    for rect in unique:
+        if not any(_intersect_rects(rect, other) == rect for other in merged):
+            merged.append(rect)
+    return merged
+
+class DamageHistory:
+    """
+    Области холста, изменившиеся в последних кадрах, и номер кадра, лежащего в каждом буфере.
+    export() переносит в буфер только то, что изменилось с тех пор, как в нем был предыдущий
+    кадр (кроме областей skip, которые вызывающий перерисует сам); незнакомый или слишком
+    давний буфер заполняется целиком
+    """
+
+    def __init__(self, full_rect, length=ENCODER_QUEUE_SIZE + 2):
+        self.full_rect = full_rect
+        self.frames = 0
+        self._regions = deque(maxlen=length)
+        self._targets = {}
+
+    def add(self, regions):
+        self._regions.append(list(regions))
+        self.frames += 1
+
+    def stale_regions(self, target):
+        entry = self._targets.get(id(target))
+        if entry is None or entry[0]() is not target or self.frames - entry[1] > len(self._regions):
+            return [self.full_rect]
+        behind = self.frames - entry[1]
+        if behind == 0:
+            return []
+        return _merge_rects([rect for regions in list(self._regions)[-behind:] for rect in regions])
+
+    def mark(self, target):
+        """
+        Запоминает, что в target лежит текущий кадр
+        """
+        key = id(target)
+        self._targets[key] = (weakref.ref(target, lambda ref: self._targets.pop(key, None)), self.frames)
+
+    def export(self, canvas, target, skip=()):
+        stale = self.stale_regions(target)
+        if skip:
+            stale = [piece for rect in stale for piece in _subtract_rects(rect, skip)]
+        for x0, y0, x1, y1 in stale:
+            if target.ndim == 3:
+                # Покомпонентное копирование заметно быстрее broadcast-присваивания в чередующиеся каналы
+                for channel in range(target.shape[2]):
+                    target[y0:y1, x0:x1, channel] = canvas[y0:y1, x0:x1]
+            else:
+                target[y0:y1, x0:x1] = canvas[y0:y1, x0:x1]
+        self.mark(target)
+        return target
+
+class FrameCompositor:
+    """
+    Собирает кадр из слоев в постоянном буфере и перерисовывает только изменившиеся области.
+    Слой - (имя, ключ содержимого, плоскость, x, y, непрозрачность) в порядке снизу вверх.
+    Слой с неизменными ключом, положением и непрозрачностью не перерисовывается, пока его
+    не задела изменившаяся область; ключ None означает, что содержимое меняется каждый кадр.
+
+    compose(layers, target) собирает кадр прямо в одноканальном буфере кодировщика target:
+    из предыдущего кадра в него переносятся только устаревшие области, которые не будут
+    перерисованы. Без target используется собственный буфер компоновщика, RGB буфер (rgb24)
+    заполняется из одноканального. canvas - буфер с последним кадром, он действителен,
+    пока его не переиспользовали
+    """
 
-    return Image.fromarray(result.astype(np.uint8))
+    def __init__(self, width=1920, height=1080, background=255):
+        self.width = width
+        self.height = height
+        self.background = background
+        self._buffer = np.full((height, width), background, dtype=np.uint8)
+        self.canvas = self._buffer
+        self.history = DamageHistory((0, 0, width, height))
+        self.frames = 0
+        self.repainted_pixels = 0
+        self._previous = {}
+
+    def _layer_rect(self, plane, x, y):
+        plane_height, plane_width = plane.shape[:2]
+        return _intersect_rects((x, y, x + plane_width, y + plane_height), (0, 0, self.width, self.height))
+
+    def compose(self, layers, target=None):
+        current = {}
+        damage = []
+
+        for name, key, plane, x, y, fade_alpha in layers:
+            state = (key, self._layer_rect(plane, x, y), fade_alpha)
+            current[name] = state
+            previous = self._previous.get(name)
+            if key is None or state != previous:
+                if previous is not None and previous[1] is not None:
+                    damage.append(previous[1])
+                if state[1] is not None:
+                    damage.append(state[1])
+
+        # Исчезнувшие слои освобождают свою область
+        for name, previous in self._previous.items():
+            if name not in current and previous[1] is not None:
+                damage.append(previous[1])
+
+        # Каждая поврежденная область собирается заново: фон и все пересекающие ее слои
+        regions = _merge_rects(damage)
+        canvas = target if target is not None and target.ndim == 2 else self._buffer
+        if canvas is not self.canvas:
+            self.history.export(self.canvas, canvas, skip=regions)
+            self.canvas = canvas
+
+        for region in regions:
+            x0, y0, x1, y1 = region
+            canvas[y0:y1, x0:x1] = self.background
+            for name, key, plane, x, y, fade_alpha in layers:
+                paste_plane(canvas, plane, x, y, fade_alpha, clip=region)
+            self.repainted_pixels += (x1 - x0) * (y1 - y0)
+
+        self.history.add(regions)
+        self.history.mark(canvas)
+        self._previous = current
+        self.frames += 1
+        if target is not None and target is not canvas:
+            return self.export(target)
+        return canvas
+
+    def export(self, target):
+        """
+        Переносит текущий кадр в буфер target (h, w) или (h, w, 3), например в буфер превью
+        """
+        return self.history.export(self.canvas, target)
+
+    @property
+    def frame(self):
+        return self.canvas
+
+    @property
+    def repainted_share(self):
+        if not self.frames:
+            return 0.0
+        return self.repainted_pixels / (self.frames * self.width * self.height)
+
+# Матрица Байера 8x8 (значения 0..63) для упорядоченного дизеринга выплывания в 1-битном кадре
+BAYER_MATRIX = np.array([
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+], dtype=np.uint8)
+
+def bayer_dither_rows(level):
+    """
+    Упакованная маска упорядоченного дизеринга: по байту на строку матрицы Байера, 1 там,
+    где порог меньше level (0..64). Период матрицы - 8, поэтому все байты строки кадра одинаковы
+    """
+    return np.packbits(BAYER_MATRIX < level, axis=1)[:, 0]
+
+def shift_packed_bits(bits, shift, length):
+    """
+    Сдвигает упакованные строки длиной length бит на shift (0..7) бит вправо,
+    не распаковывая их: результат занимает ceil((length + shift) / 8) байт
+    """
+    if not shift:
+        return bits
+    n_bytes = (length + shift + 7) // 8
+    shifted = np.zeros((bits.shape[0], n_bytes), dtype=np.uint8)
+    shifted[:, :bits.shape[1]] = bits >> shift
+    shifted[:, 1:] |= (bits << (8 - shift))[:, :n_bytes - 1]
+    return shifted
+
+def pack_plane_shifted(plane, shift, row_phase=0, fade_alpha=255):
+    """
+    Вся плоскость упакованными битами (1 - белый, старший бит слева), сдвинутыми на shift бит,
+    и маска строки. При fade_alpha < 255 осветление к белому передается дизерингом;
+    row_phase - номер строки кадра первой строки плоскости по модулю 8
+    """
+    length = plane.shape[1]
+    bits = shift_packed_bits(np.packbits(plane >= 128, axis=1), shift, length)
+    row_mask = shift_packed_bits(np.packbits(np.ones((1, length), dtype=bool), axis=1), shift, length)[0]
+    level = (255 - fade_alpha) * 64 // 255 if fade_alpha < 255 else 0
+    if level:
+        dither = bayer_dither_rows(level)[(row_phase + np.arange(bits.shape[0])) % 8]
+        bits |= dither[:, np.newaxis] & row_mask
+    return bits, row_mask
+
+def clip_packed_bits(bits, row_mask, x, y, width, height):
+    """
+    Обрезает по кадру упакованную плоскость, левый верхний пиксель которой стоит в (x, y).
+    Возвращает (биты, маска строки, строка, байт) или None, если плоскость вне кадра
+    """
+    byte = x // 8
+    b0, b1 = max(0, -byte), min(bits.shape[1], width // 8 - byte)
+    r0, r1 = max(0, -y), min(bits.shape[0], height - y)
+    if b1 <= b0 or r1 <= r0:
+        return None
+    return bits[r0:r1, b0:b1], row_mask[b0:b1], y + r0, byte + b0
+
+def pack_plane_bits(plane, x, y, width, height, fade_alpha=255):
+    """
+    Черно-белая плоскость в виде упакованных бит (1 - белый, старший бит слева), сдвинутых
+    под позицию x в кадре шириной width. Возвращает (биты, маска строки, строка, байт) или None,
+    если плоскость целиком за пределами кадра. При fade_alpha < 255 осветление к белому
+    передается упорядоченным дизерингом по координатам кадра
+    """
+    plane_height, plane_width = plane.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + plane_width, width), min(y + plane_height, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    # Упаковывается только видимая часть; сдвиг на x0 % 8 бит - слой начинается не с границы байта
+    bits, row_mask = pack_plane_shifted(plane[y0 - y:y1 - y, x0 - x:x1 - x], x0 % 8, y0 % 8, fade_alpha)
+    return bits, row_mask, y0, x0 // 8
+
+def unpack_frame_bits(packed, width):
+    """
+    Упакованный 1-битный кадр в одноканальный uint8 (0/255)
+    """
+    return np.unpackbits(packed, axis=1, count=width) * np.uint8(255)
+
+class BitplaneCompositor:
+    """
+    Компоновщик 1-битного кадра: холст хранится упакованными битами (строка = width / 8 байт),
+    вставка слоя - побитовые операции с маской. Кадр передается кодировщику в формате monob
+    без распаковки, поэтому объем данных в 24 раза меньше, чем у RGB кадра.
+    Как и FrameCompositor, перерисовывает только изменившиеся области (в байтах строки) и
+    собирает кадр прямо в буфере кодировщика. Слои с ключом кэшируются в упакованном виде
+    независимо от положения (важен только сдвиг внутри байта); выплывание передается дизерингом
+    """
+
+    def __init__(self, width=1920, height=1080, background=255,
+                 max_packed_bytes=LAYER_CACHE_MAX_MB * 1024 * 1024 // 8):
+        if width % 8:
+            raise ValueError("Ширина 1-битного кадра должна быть кратна 8")
+        self.width = width
+        self.height = height
+        self.background = 0xFF if background >= 128 else 0x00
+        self._buffer = np.full((height, width // 8), self.background, dtype=np.uint8)
+        self.canvas = self._buffer
+        self.history = DamageHistory((0, 0, width // 8, height))
+        # Упакованный слой в 8 раз меньше слоя яркости, поэтому и лимит в 8 раз меньше кэша слоев
+        self.max_packed_bytes = max_packed_bytes
+        self._packed = OrderedDict()
+        self._packed_bytes = 0
+        self._previous = {}
+        self.frames = 0
+        self.repainted_bytes = 0
+
+    def _packed_layer(self, key, plane, x, y, fade_alpha):
+        if key is None:
+            return pack_plane_bits(plane, x, y, self.width, self.height, fade_alpha)
+
+        # Слой упаковывается целиком: биты зависят только от сдвига в байте и фазы дизеринга,
+        # а не от положения, поэтому дрожащий слой (в том числе выходящий за кадр) берется из кэша
+        cache_key = (key, x % 8, y % 8 if fade_alpha < 255 else 0, fade_alpha)
+        packed = self._packed.get(cache_key)
+        if packed is not None:
+            self._packed.move_to_end(cache_key)
+        else:
+            packed = pack_plane_shifted(plane, x % 8, y % 8, fade_alpha)
+            self._packed[cache_key] = packed
+            self._packed_bytes += packed[0].nbytes
+            while self._packed_bytes > self.max_packed_bytes and len(self._packed) > 1:
+                self._packed_bytes -= self._packed.popitem(last=False)[1][0].nbytes
+        return clip_packed_bits(*packed, x, y, self.width, self.height)
+
+    def compose(self, layers, target=None):
+        current = {}
+        packed_layers = []
+        damage = []
+
+        for name, key, plane, x, y, fade_alpha in layers:
+            packed = self._packed_layer(key, plane, x, y, fade_alpha)
+            rect = None
+            if packed is not None:
+                bits, row_mask, row, byte = packed
+                rect = (byte, row, byte + bits.shape[1], row + bits.shape[0])
+                packed_layers.append(packed)
+            state = (key, x, y, fade_alpha, rect)
+            current[name] = state
+            previous = self._previous.get(name)
+            if key is None or state != previous:
+                if previous is not None and previous[4] is not None:
+                    damage.append(previous[4])
+                if rect is not None:
+                    damage.append(rect)
+
+        # Исчезнувшие слои освобождают свою область
+        for name, previous in self._previous.items():
+            if name not in current and previous[4] is not None:
+                damage.append(previous[4])
+
+        regions = _merge_rects(damage)
+        canvas = self._buffer if target is None else target
+        if canvas is not self.canvas:
+            self.history.export(self.canvas, canvas, skip=regions)
+            self.canvas = canvas
+
+        # Каждая поврежденная область собирается заново: фон и все пересекающие ее слои
+        for region in regions:
+            x0, y0, x1, y1 = region
+            canvas[y0:y1, x0:x1] = self.background
+            for bits, row_mask, row, byte in packed_layers:
+                clip = _intersect_rects(region, (byte, row, byte + bits.shape[1], row + bits.shape[0]))
+                if clip is None:
+                    continue
+                cx0, cy0, cx1, cy1 = clip
+                area = canvas[cy0:cy1, cx0:cx1]
+                mask = row_mask[cx0 - byte:cx1 - byte]
+                np.bitwise_and(area, ~mask, out=area)
+                np.bitwise_or(area, bits[cy0 - row:cy1 - row, cx0 - byte:cx1 - byte], out=area)
+            self.repainted_bytes += (x1 - x0) * (y1 - y0)
+
+        self.history.add(regions)
+        self.history.mark(canvas)
+        self._previous = current
+        self.frames += 1
+        return canvas
+
+    def export(self, target):
+        """
+        Переносит текущий кадр в буфер target (упакованные биты, как canvas), например в буфер превью
+        """
+        return self.history.export(self.canvas, target)
+
+    @property
+    def frame(self):
+        return self.canvas
+
+    @property
+    def repainted_share(self):
+        if not self.frames:
+            return 0.0
+        return self.repainted_bytes / (self.frames * self.canvas.size)
+
+def create_compositor(width, height, mode=COMPOSITOR_MODE, input_pix_fmt=ENCODER_INPUT_PIX_FMT):
+    """
+    Компоновщик кадра и формат пикселей кадра для кодировщика. 8-битный холст переносится
+    в буферы кодировщика как есть (gray) или в три канала (rgb24)
+    """
+    if mode == "bitplane":
+        return BitplaneCompositor(width, height), 'monob'
+    if mode != "gray":
+        raise ValueError(f"Неизвестный режим компоновщика: {mode}")
+    if input_pix_fmt not in ('gray', 'rgb24'):
+        raise ValueError(f"Неподдерживаемый формат кадра: {input_pix_fmt}")
+    return FrameCompositor(width, height), input_pix_fmt
+
+def apply_ultra_hard_threshold_effect(img, amplitude):
+    luminance = np.asarray(luminance_image(img))
+    return Image.fromarray(apply_threshold(luminance, amplitude)).convert('RGB')
 
 def extract_album_art(audio_path, user_dir):
     try:
@@ -5,9 +5,12 @@ AUDIO_FILE = "thirteen.mp3"
 IMAGE_FILE = "cover.jpg"
 GIF_FILE = "source/animation.gif"  # Фиксированный GIF
 OUTPUT_FILE = "visualizer_output.mp4"
+CACHE_DIR = "cache"  # Кэш предобработанных данных (атлас GIF и т.п.)
 
 # Шрифт
 FONT_FILE = "source/MisterBrush.ttf"  # Фиксированный шрифт
+FONT_CACHE_SIZE = 64        # Шрифтов (путь, размер) в памяти процесса
+TEXT_BLOCK_CACHE_SIZE = 32  # Готовых блоков текста в памяти процесса
 
 # Параметры визуализации
 BPM = 128.0
@@ -15,6 +18,9 @@ BEATS_PER_LOOP = 8
 
 # Качество аудио
 AUDIO_SAMPLE_RATE = 48000  # 48 кГц
+# Частота анализа для визуализаций (звук видео не затрагивается). Спектр показывает полосу
+# от 0 до половины этой частоты: 0-12 кГц при 24000; 48000 вернет прежний диапазон 0-24 кГц
+ANALYSIS_SAMPLE_RATE = 24000
 AUDIO_BIT_DEPTH = 24       # 24 бита
 
 # � азмеры и отступы
@@ -26,8 +32,17 @@ TEXT_GAP_HEIGHT = 90
 VISUALIZATION_WIDTH = 450
 VISUALIZATION_HEIGHT_WAVEFORM = 250
 VISUALIZATION_HEIGHT_SPECTRUM = 250
+WAVEFORM_WINDOW = 2.0  # Окно волны вокруг кадра, секунд
 
 GIF_BASE_WIDTH = VISUALIZATION_WIDTH
+GIF_ATLAS_VERSION = 1  # Увеличить при изменении формата атласа GIF
+
+# Кэш декодированного звука, признаков трека и этапов рендера
+PCM_CACHE_MAX_MB = 2048   # Ограничение размера кэша на диске, МБ (0 - без кэша)
+PCM_CACHE_VERSION = 3     # Увеличить при изменении способа декодирования
+FEATURES_VERSION = 5      # Увеличить при изменении алгоритмов анализа (признаки трека)
+STAGES_VERSION = 1        # Увеличить при изменении этапов рендера (обложка, текст, панели, наложения)
+STAGE_CACHE_MAX_MB = 512  # Ограничение размера кэша этапов рендера, МБ (0 - без кэша)
 
 # Эффекты приближения (коэффициенты)
 MULTIPLIER_MAIN_IMAGE = 0.08
@@ -40,6 +55,62 @@ THRESHOLD_RANGE = 240
 CONTRAST_BASE = 1.5
 CONTRAST_AMPLITUDE_MULTIPLIER = 2
 
+# Анализ амплитуды
+AMPLITUDE_WINDOW = 0.01   # Окно вокруг кадра, секунд
+AMPLITUDE_MODE = "peak"   # "peak" или "rms"
+
+# Спектр
+SPECTRUM_WINDOW = 0.2            # Окно анализа, секунд
+SPECTRUM_MIN_FFT = 2048          # Минимальный размер FFT при AUDIO_SAMPLE_RATE (пересчитывается на частоту анализа)
+SPECTRUM_SMOOTHING_SIGMA = 0.8   # Гауссово сглаживание спектра
+SPECTRUM_BATCH_SIZE = 64         # Кадров в одном пакетном FFT
+
+# Рендер
+RENDER_WORKERS = 1  # Число процессов рендера (1 - последовательный рендер)
+
+# Профили рендера: ширина, высота, кадров в секунду.
+# Размеры слоев выше заданы для 1920x1080 и масштабируются пропорционально высоте кадра
+RENDER_PROFILES = {
+    "draft": (640, 360, 15),
+    "preview": (1280, 720, 30),
+    "final": (1920, 1080, 30),
+}
+RENDER_PROFILE = "final"            # Профиль основного видео
+PREVIEW_RENDER_PROFILE = "preview"  # Профиль отдельного рендера превью (preview_only)
+
+# Потоковый режим для длинных треков и миксов: звук анализируется блоками, признаки и геометрия
+# панелей не держатся в памяти целиком, поэтому память рендера не зависит от длины трека
+STREAMING_MIN_DURATION = 1200  # Треки не короче (секунд) рендерятся потоково (None - никогда)
+STREAMING_CHUNK_SECONDS = 30   # Размер блока декодирования и анализа, секунд
+
+# Компоновщик кадра: "gray" - 8-битный холст, RGB кадры для кодировщика;
+# "bitplane" - 1-битный холст и кадры monob (выплывание передается дизерингом)
+COMPOSITOR_MODE = "gray"
+
+# Кодирование видео (ffmpeg)
+VIDEO_CODEC = "libx264"
+VIDEO_PRESET = "medium"
+VIDEO_CRF = 23
+VIDEO_THREADS = 0          # 0 - автоматически
+VIDEO_PIX_FMT = "yuv420p"  # yuv420p воспроизводится YouTube и Telegram; gray (4:0:0) поддерживают не все плееры
+ENCODER_INPUT_PIX_FMT = "gray"  # Формат кадров 8-битного компоновщика на входе ffmpeg: "gray" или "rgb24"
+AUDIO_CODEC = "aac"
+AUDIO_BITRATE = None       # None - битрейт AAC по умолчанию в ffmpeg (как было с moviepy)
+AUDIO_COPY_CODECS = ["aac"]  # Кодеки исходного звука, которые копируются в MP4 без перекодирования
+ENCODER_QUEUE_SIZE = 8     # Кадров в очереди на запись в ffmpeg
+
+# Превью для Telegram
+PREVIEW_DURATION = 15          # Длительность превью, секунд
+PREVIEW_WIDTH = 1280           # Ширина превью (0 - как у основного видео)
+PREVIEW_CRF = 28
+PREVIEW_AUDIO_BITRATE = "128k"
+PREVIEW_FIRST = True           # Бот сначала рендерит только превью, полное видео - после подтверждения
+PREVIEW_SPECULATIVE_RENDER = False  # Начинать полный рендер сразу после отправки превью
+
+# Кэш готовых слоев
+AMPLITUDE_QUANTIZATION_STEP = 0.01  # Шаг квантования амплитуды (0 - без квантования)
+LAYER_CACHE_MAX_MB = 256            # Ограничение памяти кэша, МБ
+
 # Сглаживание амплитуды
 SMOOTHING_WINDOW_SIZE = 3
 SMOOTHING_ALPHA = 0.1
@@ -0,0 +1,53 @@
+import numpy as np
+
+import processor
+from settings import *
+
+
+def test_streaming_features_match_whole_track(make_wav, tmp_path):
+    """
+    Потоковый анализ по блокам дает те же признаки, что и анализ всего трека
+    """
+    audio_path = make_wav(7.0)
+    sr, fps = ANALYSIS_SAMPLE_RATE, 30
+    mono = np.concatenate(list(processor.decode_mono_chunks(audio_path, sr, 1 << 16)))
+    expected = processor.compute_track_features(mono, sr, fps)
+
+    features_dir = tmp_path / "features"
+    processor.compute_track_features_streaming(audio_path, str(features_dir), sr, fps, chunk_seconds=1.0)
+    assert int(np.load(features_dir / "n_samples.npy")) == len(mono)
+    for name, values in expected.items():
+        assert np.array_equal(np.load(features_dir / f"{name}.npy"), values), name
+
+
+def test_column_peaks_match_brute_force():
+    """
+    Пики столбцов совпадают с минимумом и максимумом, посчитанными по каждому столбцу отдельно
+    """
+    rng = np.random.default_rng(0)
+    samples = (rng.standard_normal(50000) * 0.3).astype(np.float32)
+    samples[rng.integers(0, len(samples), 100)] = 0.99
+
+    for _ in range(500):
+        start = int(rng.integers(0, len(samples)))
+        end = int(rng.integers(start + 1, len(samples) + 1))
+        step = int(rng.integers(1, 2000))
+        columns = int(rng.integers(1, -(-(end - start) // step) + 1))
+        mins, maxs = processor.column_peaks(samples, start, step, columns, end)
+        expected = [samples[start + i * step:min(start + (i + 1) * step, end)] for i in range(columns)]
+        assert np.array_equal(mins, [column.min() for column in expected])
+        assert np.array_equal(maxs, [column.max() for column in expected])
+
+
+def test_waveform_peaks_cover_every_sample():
+    """
+    Волна - максимум модуля каждого столбца окна waveform_window: одиночный щелчок не теряется
+    """
+    sr, width = ANALYSIS_SAMPLE_RATE, VISUALIZATION_WIDTH
+    samples = np.zeros(sr * 5, dtype=np.float32)
+    samples[2 * sr + 7] = -0.9
+    for current_sample in range(sr, 4 * sr, 997):
+        peaks = processor.waveform_peaks(samples, current_sample, sr, width)
+        assert len(peaks) == len(processor.waveform_window(samples, current_sample / sr, sr, width))
+        window = samples[max(0, current_sample - sr):current_sample + sr]
+        assert peaks.max() == np.abs(window).max()
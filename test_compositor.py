@@ -0,0 +1,32 @@
+import random
+
+import numpy as np
+import pytest
+
+import processor
+from benchmarks import synthetic_layers
+from settings import *
+
+
+@pytest.mark.parametrize("mode, pix_fmt", [("gray", "gray"), ("gray", "rgb24"), ("bitplane", "monob")])
+def test_incremental_composite_matches_fresh(mode, pix_fmt):
+    """
+    Кадр, собранный с перерисовкой только изменившихся областей в переиспользуемые буферы
+    (в случайном порядке, в том числе давно не использованные), совпадает с кадром,
+    собранным с нуля новым компоновщиком
+    """
+    width, height = 320, 180
+    rng = random.Random(0)
+    compositor, frame_pix_fmt = processor.create_compositor(width, height, mode, pix_fmt)
+    shape = processor.raw_frame_shape(frame_pix_fmt, width, height)
+    pool = [np.full(shape, 77, dtype=np.uint8) for _ in range(ENCODER_QUEUE_SIZE + 4)]
+
+    for index, layers in enumerate(synthetic_layers(width, height, 60, fade_frames=20)):
+        # Слой GIF время от времени исчезает и освобождает свою область
+        if index % 7 == 3:
+            layers = [layer for layer in layers if layer[0] != 'gif']
+        frame = compositor.compose(layers, rng.choice(pool))
+
+        fresh, _ = processor.create_compositor(width, height, mode, pix_fmt)
+        expected = fresh.compose(layers, np.zeros(shape, dtype=np.uint8))
+        assert np.array_equal(frame, expected), f"кадр {index}"
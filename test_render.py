@@ -0,0 +1,140 @@
+import collections
+import hashlib
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import processor
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class RecordingWriter:
+    """
+    Кодировщик для тестов с интерфейсом FFmpegWriter: вместо видео пишет в output_path
+    хэши кадров (по строке на кадр). Буферы выдаются по кругу из пула с мусором,
+    поэтому кадр, собранный не целиком, меняет хэш
+    """
+
+    def __init__(self, output_path, size, fps, audio=None, input_pix_fmt='rgb24', pool_size=4, **kwargs):
+        self.output_path = output_path
+        rng = np.random.default_rng(len(str(output_path)))
+        shape = processor.raw_frame_shape(input_pix_fmt, *size)
+        self._free = collections.deque(rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(pool_size))
+        self.hashes = []
+
+    def acquire_buffer(self):
+        return self._free.popleft()
+
+    def write_buffer(self, buffer):
+        self.hashes.append(hashlib.sha1(buffer.tobytes()).hexdigest())
+        self._free.append(buffer)
+
+    def write_frame(self, frame):
+        buffer = self.acquire_buffer()
+        buffer[...] = frame
+        self.write_buffer(buffer)
+
+    def repeat_frame(self):
+        self.hashes.append(self.hashes[-1])
+
+    def close(self):
+        with open(self.output_path, 'w') as f:
+            f.write("\n".join(self.hashes))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _use_recording_writer():
+    """
+    Инициализатор воркера для тестов: кадры уходят в RecordingWriter
+    (подмена в основном процессе не видна процессам spawn/forkserver)
+    """
+    processor.FFmpegWriter = RecordingWriter
+
+
+@pytest.fixture
+def render_args(make_wav, tmp_path, monkeypatch):
+    """
+    Аргументы _load_segment_renderer для короткого трека; все кэши пишутся в tmp_path
+    """
+    # Из репозитория читаются только фиксированные GIF и шрифт (source/)
+    monkeypatch.chdir(REPO_DIR)
+    audio_path = make_wav(2.0)
+    image_path = str(tmp_path / "cover.jpg")
+    gradient = np.add.outer(np.arange(400), np.arange(400)) * 255 // 798
+    Image.fromarray(gradient.astype(np.uint8)).convert('RGB').save(image_path)
+    return audio_path, image_path, "Artist", "Title", 128, 8, 'draft', str(tmp_path / "cache")
+
+
+def test_parallel_render_matches_serial(render_args, tmp_path, monkeypatch):
+    """
+    Кадры, отрендеренные сегментами в отдельных процессах или одним рендером сегмент за сегментом,
+    совпадают с кадрами одного прохода
+    """
+    monkeypatch.setattr(processor, 'FFmpegWriter', RecordingWriter)
+    renderer = processor._load_segment_renderer(*render_args)
+    total_frames = renderer.total_frames
+
+    size = (renderer.compositor.width, renderer.compositor.height)
+    serial_path = tmp_path / "serial.txt"
+    with RecordingWriter(serial_path, size, renderer.fps, input_pix_fmt=renderer.frame_pix_fmt) as writer:
+        processor.render_frames(renderer, writer, 0, total_frames)
+
+    # Второй сегмент начинается внутри статичного начала: его первый кадр повторяет кадр другого сегмента
+    bounds = [0, 2, total_frames // 2, total_frames]
+    segments = [(render_args, int(start), int(end), str(tmp_path / f"segment_{i}.txt"))
+                for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))]
+    with processor.render_process_context().Pool(len(segments), initializer=_use_recording_writer) as pool:
+        segment_paths = pool.map(processor._render_segment, segments)
+
+    # Воркер может получить несколько сегментов подряд: рендер переиспользуется между ними
+    reused_paths = [processor._render_segment((args, start, end, path + ".reused"))
+                    for args, start, end, path in segments]
+
+    serial = serial_path.read_text().split("\n")
+    assert len(serial) == total_frames
+    for paths in (segment_paths, reused_paths):
+        assert [line for path in paths for line in open(path).read().split("\n")] == serial
+
+
+
+@pytest.mark.parametrize("mode, pix_fmt", [("gray", "gray"), ("gray", "rgb24"), ("bitplane", "monob")])
+def test_continued_render_matches_serial(render_args, tmp_path, mode, pix_fmt):
+    """
+    Рендер, продолженный тем же рендером в другой кодировщик с кадра внутри статичного начала,
+    совпадает с одним проходом: первый кадр повторяет последний кадр прошлого кодировщика
+    """
+    renderer = processor._load_segment_renderer(*render_args)
+    width, height = renderer.compositor.width, renderer.compositor.height
+
+    hashes = {}
+    for name, bounds in (("serial", [0, renderer.total_frames]), ("continued", [0, 2, renderer.total_frames])):
+        renderer.compositor, renderer.frame_pix_fmt = processor.create_compositor(width, height, mode, pix_fmt)
+        renderer._last_signature = None
+        hashes[name] = []
+        for i, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            path = tmp_path / f"{name}_{i}.txt"
+            with RecordingWriter(path, (width, height), renderer.fps, input_pix_fmt=renderer.frame_pix_fmt) as writer:
+                processor.render_frames(renderer, writer, start, end)
+            hashes[name] += path.read_text().split("\n")
+    assert hashes["continued"] == hashes["serial"]
+
+def test_segment_error_reaches_parent(render_args, tmp_path):
+    """
+    Ошибка построения рендера в воркере (например, недоступный файл) завершает рендер
+    исключением, а не бесконечным перезапуском процессов пула
+    """
+    broken_args = (str(tmp_path / "missing.wav"),) + render_args[1:]
+    with processor.render_process_context().Pool(1) as pool:
+        result = pool.map_async(processor._render_segment, [(broken_args, 0, 1, str(tmp_path / "segment.txt"))])
+        result.wait(120)
+        assert result.ready()
+        with pytest.raises(FileNotFoundError):
+            result.get()